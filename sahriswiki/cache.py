@@ -0,0 +1,238 @@
+# Module:   cache
+
+"""Render Cache
+
+An in-memory LRU cache of rendered pages bounded by size in bytes,
+optionally spilling evicted entries to disk, and a smaller one of
+rendered not found pages.
+"""
+
+import os
+import re
+from time import time
+from hashlib import md5
+from threading import Lock
+from collections import OrderedDict
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+
+HEXDIGEST = re.compile("^[0-9a-f]{32}$")
+
+
+class RenderCache(object):
+    """LRU cache of pickled entries bounded by a byte budget.
+
+    Entries evicted from memory are written to ``path`` (if given) and
+    brought back into memory the next time they are looked up.
+    """
+
+    def __init__(self, size, path=None):
+        super(RenderCache, self).__init__()
+
+        self.size = size
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._used = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+        if self.path is not None and not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (
+                self.path is not None and os.path.isfile(self._filename(key)))
+
+    def _filename(self, key):
+        return os.path.join(self.path, md5(repr(key)).hexdigest())
+
+    def _load(self, key):
+        """Load and remove a spilled entry from disk."""
+
+        if self.path is None:
+            return None
+
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.unlink(filename)
+        except (IOError, OSError):
+            return None
+
+        return data
+
+    def _spill(self, key, data):
+        """Write an evicted entry to disk."""
+
+        if self.path is None:
+            return
+
+        try:
+            with open(self._filename(key), "wb") as f:
+                f.write(data)
+        except (IOError, OSError):
+            pass
+
+    def _store(self, key, data):
+        if key in self._entries:
+            self._used -= len(self._entries.pop(key))
+
+        if len(data) > self.size:
+            self._spill(key, data)
+            return
+
+        self._entries[key] = data
+        self._used += len(data)
+
+        while self._used > self.size:
+            old, old_data = self._entries.popitem(last=False)
+            self._used -= len(old_data)
+            self._spill(old, old_data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+            else:
+                data = self._load(key)
+                if data is not None:
+                    self._store(key, data)
+
+            if data is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+
+        return loads(data)
+
+    def set(self, key, value):
+        data = dumps(value, HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._store(key, data)
+
+    def discard(self, key):
+        with self._lock:
+            self.invalidations += 1
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._used -= len(data)
+            elif self.path is not None:
+                try:
+                    os.unlink(self._filename(key))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._used = 0
+
+            if self.path is not None:
+                for filename in os.listdir(self.path):
+                    if not HEXDIGEST.match(filename):
+                        continue
+                    try:
+                        os.unlink(os.path.join(self.path, filename))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "bytes": self._used,
+            "size": self.size,
+        }
+
+
+class NotFoundCache(object):
+    """LRU cache of rendered not found pages keyed by page title.
+
+    Entries expire after ``ttl`` seconds, so that the suggested pages
+    they list don't go stale, and are discarded as soon as a page with
+    their title is created.
+    """
+
+    def __init__(self, size, ttl=300):
+        super(NotFoundCache, self).__init__()
+
+        self.size = size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = Lock()
+        self._entries = OrderedDict()  # key -> (time, body)
+        self._keys = {}                # title -> keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys[key[0]]
+
+    def get(self, key):
+        """Gives the body cached for key (whose first item is the title)."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if time() - entry[0] < self.ttl:
+                    self._entries[key] = self._entries.pop(key)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(key)
+
+            self.misses += 1
+            return None
+
+    def set(self, key, body):
+        if not self.size:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time(), body)
+            self._keys.setdefault(key[0], set()).add(key)
+
+            while len(self._entries) > self.size:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, title):
+        """Discard all entries for title."""
+
+        with self._lock:
+            for key in list(self._keys.get(title, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "size": self.size,
+        }
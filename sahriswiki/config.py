@@ -8,6 +8,8 @@
 """
 
 import ConfigParser
+from hashlib import md5
+from marshal import dumps
 from warnings import warn
 from os import environ, path
 
@@ -28,9 +30,32 @@ class Config(reprconf.Config):
         self.parse_options()
         self.check_options()
 
+    def reset(self):
+        self._digest = None
+        super(Config, self).reset()
+
+    def _apply(self, config):
+        self._digest = None
+        super(Config, self)._apply(config)
+
+    def __setitem__(self, k, v):
+        self._digest = None
+        super(Config, self).__setitem__(k, v)
+
+    def __delitem__(self, k):
+        self._digest = None
+        super(Config, self).__delitem__(k)
+
+    def digest(self):
+        """MD5 hex digest of the options, computed again only after changes."""
+
+        if self._digest is None:
+            self._digest = md5(dumps(self.copy())).hexdigest()
+        return self._digest
+
     def check_options(self):
         path_options = (
-            "accesslog", "config", "repo", "errorlog",
+            "accesslog", "cache-dir", "config", "repo", "errorlog",
             "pidfile", "sock", "theme",
         )
 
@@ -56,6 +81,12 @@ class Config(reprconf.Config):
 
         add = parser.add_argument
 
+        add(
+            "command", action="store", nargs="?", default="serve",
+            choices=("serve", "reindex"), metavar="COMMAND",
+            help="Run COMMAND: serve (default) or reindex the search index"
+        )
+
         add(
             "--config", action="store", default=None,
             dest="config", metavar="FILE", type=str,
@@ -234,6 +265,62 @@ class Config(reprconf.Config):
             help="Set static baseurl to URL"
         )
 
+        add(
+            "--search", action="store", default="words",
+            dest="search", metavar="BACKEND", type=str,
+            help="Use search BACKEND (words, or fts for SQLite FTS5)"
+        )
+
+        add(
+            "--index-interval", action="store", default=60,
+            dest="index-interval", metavar="SECONDS", type=int,
+            help="Check for changes to index every SECONDS at the latest"
+        )
+
+        add(
+            "--cache-size", action="store", default=32,
+            dest="cache-size", metavar="MB", type=int,
+            help="Set rendered page cache size to MB megabytes (0 disables)"
+        )
+
+        add(
+            "--cache-dir", action="store", default=None,
+            dest="cache-dir", metavar="DIR", type=str,
+            help="Spill rendered pages evicted from memory to DIR"
+        )
+
+        add(
+            "--notfound-cache", action="store", default=1000,
+            dest="notfound-cache", metavar="N", type=int,
+            help="Cache up to N rendered not found pages (0 disables)"
+        )
+
+        add(
+            "--notfound-rate", action="store", default=1.0,
+            dest="notfound-rate", metavar="RATE", type=float,
+            help="Limit not found pages to RATE per second per client "
+                 "(0 disables)"
+        )
+
+        add(
+            "--notfound-burst", action="store", default=30,
+            dest="notfound-burst", metavar="N", type=int,
+            help="Allow bursts of up to N not found pages per client"
+        )
+
+        add(
+            "--trusted-proxies", action="append", default=None,
+            dest="trusted-proxies", metavar="IP", type=str,
+            help="Take client addresses from X-Forwarded-For set by proxies "
+                 "at IP (may be repeated)"
+        )
+
+        add(
+            "-j", "--jobs", action="store", default=None,
+            dest="jobs", metavar="N", type=int,
+            help="Use N processes to reindex (default: number of CPUs)"
+        )
+
         namespace = parser.parse_args()
 
         if namespace.config is not None:
@@ -1,360 +1,611 @@
-# core.py
-# -*- coding: utf-8 -*-
-#
-# Copyright © Stephen Day
-#
-# This module is part of Creoleparser and is released under
-# the MIT License: http://www.opensource.org/licenses/mit-license.php
-#
-
-import re, string
-import warnings
-
-import genshi.builder as bldr
-
-__docformat__ = 'restructuredtext en'
-
-escape_char = '~'
-esc_neg_look = '(?<!' + re.escape(escape_char) + ')'
-esc_to_remove = re.compile(''.join([r'(?<!',re.escape(escape_char),')',re.escape(escape_char),r'(?!([ \n]|$))']))
-place_holder_re = re.compile(r'<<<(-?\d+?)>>>')
-
-
-class Parser(object):
-    
-    def __init__(self,dialect, method='xhtml', strip_whitespace=False, encoding='utf-8'):
-        """Constructor for Parser objects
-
-        :parameters:
-          dialect
-            Usually created using :func:`creoleparser.dialects.create_dialect`
-          method
-            This value is passed to Genshies Steam.render(). Possible values
-            include ``xhtml``, ``html``, ``xml``, and ``text``.
-          strip_whitespace
-            This value is passed to Genshies Steam.render().
-          encoding
-            This value is passed to Genshies Steam.render(). If ``None``, the ouput
-            will be a unicode object.
-            
-        """
-    
-        if isinstance(dialect,type):
-            self.dialect = dialect()
-        else:
-            warnings.warn("""
-'dialect' should be a type object.
-"""
-                  )
-            self.dialect = dialect
-        self.method = method
-        self.strip_whitespace = strip_whitespace
-        self.encoding=encoding
-
-
-    def parse(self,text,element_store=None,context='block', environ=None, preprocess=True):
-        """Returns a Genshi Fragment (basically a list of Elements and text nodes).
-
-        :parameters:
-          text
-            The text to be parsed.
-          context
-            This is useful for marco development where (for example) supression
-            of paragraph tags is desired. Can be 'inline', 'block', or a list
-            of WikiElement objects (use with caution).
-          element_store
-            Internal dictionary that's passed around a lot ;)
-          environ
-            This can be any type of object. It will be passed to ``macro_func``
-            unchanged (for a description of ``macro_func``, see
-            :func:`~creoleparser.dialects.create_dialect`).
-          preprocess
-            Passes text through preprocess method that replaces Windows style
-            line breaks.
-            
-        """
-        
-        if element_store is None:
-            element_store = {}
-        if not isinstance(context,list):
-            if context == 'block':
-                top_level_elements = self.dialect.block_elements
-            elif context == 'inline':
-                top_level_elements = self.dialect.inline_elements
-        else:
-            top_level_elements = context
-
-        if preprocess:
-            text = self.preprocess(text)
-
-        return bldr.tag(fragmentize(text,top_level_elements,element_store, environ))
-
-
-
-    def generate(self,text,element_store=None,context='block', environ=None, preprocess=True):
-        """Returns a Genshi Stream. See
-        :meth:`~creoleparser.core.Parser.parse` for named parameter descriptions.
-
-        """
-
-        return self.parse(text, element_store, context, environ, preprocess).generate()
-
-
-    def render(self, text, element_store=None, context='block', environ=None, preprocess=True, **kwargs):
-        """Returns the final output string (e.g., xhtml). See
-        :meth:`~creoleparser.core.Parser.parse` for named parameter descriptions.
-
-        Left over keyword arguments (``kwargs``) will be passed to Genshi's Stream.render() method,
-        overriding the corresponding attributes of the Parser object. For more infomation on Streams,
-        see the `Genshi documentation <http://genshi.edgewall.org/wiki/Documentation/streams.html#serialization-options>`_.
-        
-        """
-
-        kwargs.setdefault('method',self.method)
-        kwargs.setdefault('encoding',self.encoding)
-        if kwargs['method'] != "text":
-            kwargs.setdefault('strip_whitespace',self.strip_whitespace)
-        stream = self.generate(text, element_store, context, environ, preprocess)
-        return stream.render(**kwargs)
-
-    def __call__(self,text, **kwargs):
-        """Wrapper for the render method. Returns final output string.
-
-        """
-
-        return self.render(text, **kwargs)
-
-    def preprocess(self,text):
-        """This should generally be called before fragmentize().
-
-        :parameters:
-          text
-            text to be processsed.
-
-        """
-        text = text.replace("\r\n", "\n")
-        text = text.replace("\r", "\n")
-
-        return text    
-
-
-
-class ArgParser(object):
-    """Creates a callable object for parsing macro argument strings
-
-    >>> from dialects import creepy20_base
-    >>> my_parser = ArgParser(dialect=creepy20_base())
-    >>> my_parser(" one two foo='three' boo='four' ")
-    (['one', 'two'], {'foo': 'three', 'boo': 'four'})
- 
-    A parser returns a two-tuple, the first item being a list of positional
-    arguments and the second a dictionary of keyword arguments. Argument
-    values are either strings or lists.
-    
-    """
-    
-    def __init__(self,dialect, convert_implicit_lists=True,
-                 arg_func=None, key_func=None, illegal_keys=(),
-                 convert_unicode_keys=True):
-        """Constructor for ArgParser objects
-
-        :parameters:
-          convert_unicode_keys
-            If *True*, keys will be converted using ``str(key)`` before being
-            added to the output dictionary. This allows the dictionary to be
-            safely passed to functions using the special ``**`` form (i.e.,
-            ``func(**kwargs)``).
-          dialect
-            Usually created using :func:`~creoleparser.dialects.creepy10_base`
-            or :func:`~creoleparser.dialects.creepy20_base`
-          convert_implicit_lists
-            If *True*, all implicit lists will be converted to strings
-            using ``' '.join(list)``. "Implicit" lists are created when
-            positional arguments follow keyword arguments
-            (see :func:`~creoleparser.dialects.creepy10_base`). 
-          illegal_keys
-            A tuple of keys that will be post-fixed with an underscore if found
-            during parsing. 
-          arg_func
-            If supplied, this function will be used to transform the values
-            of the positional arguments.
-          key_func
-            If supplied, this function will be used to transform the names
-            and values of keyword arguments. It must accept two positional
-            arguments. For example, this can be used to make keywords case
-            insensitive:
-            
-            >>> from string import lower
-            >>> from dialects import creepy20_base
-            >>> my_parser = ArgParser(dialect=creepy20_base(),
-            ...     key_func=lambda k, v: k, v.lower())
-            >>> my_parser(" Foo='one' ")
-            ([], {'foo': 'one'})
-            
-        """
-    
-        self.dialect = dialect()
-        self.convert_implicit_lists = convert_implicit_lists
-        self.arg_func = arg_func
-        self.key_func = key_func
-        self.illegal_keys = illegal_keys
-        self.convert_unicode_keys = convert_unicode_keys
-
-
-    def __call__(self, arg_string, **kwargs): 
-        """Parses the ``arg_string`` returning a two-tuple 
-
-        Keyword arguments (``kwargs``) can be used to override the corresponding
-        attributes of the ArgParser object (see above). However, the
-        ``dialect`` attribute **cannot** be overridden.
-        
-        """
-        
-        kwargs.setdefault('convert_implicit_lists',self.convert_implicit_lists)
-        kwargs.setdefault('arg_func',self.arg_func)
-        kwargs.setdefault('key_func',self.key_func)
-        kwargs.setdefault('illegal_keys',self.illegal_keys)
-        kwargs.setdefault('convert_unicode_keys',self.convert_unicode_keys)
-
-        return self._parse(arg_string,**kwargs)
-
-
-    def _parse(self,arg_string, convert_implicit_lists, arg_func, key_func,
-            illegal_keys, convert_unicode_keys):
-        
-        frags = fragmentize(arg_string,self.dialect.top_elements,{},{},
-                remove_escapes=False)
-        positional_args = []
-        kw_args = {}
-        for arg in frags:
-           if isinstance(arg,tuple):
-             k, v  = arg
-             if convert_unicode_keys:
-                 k = str(k)
-             if key_func:
-                 k, v =  key_func(k, v)
-             if k in illegal_keys:
-                 k = k + '_'
-             if k in kw_args:
-                if isinstance(v,list):
-                   try:
-                      kw_args[k].extend(v)
-                   except AttributeError:
-                      v.insert(0,kw_args[k])
-                      kw_args[k] = v
-                elif isinstance(kw_args[k],list):
-                   kw_args[k].append(v)
-                else:
-                   kw_args[k] = [kw_args[k], v]
-                kw_args[k] = ImplicitList(kw_args[k])
-             else:
-                kw_args[k] = v
-             if isinstance(kw_args[k],ImplicitList) and convert_implicit_lists:
-                 kw_args[k] = ' ' .join(kw_args[k])
-           else:
-             if arg_func:
-                 arg = arg_func(arg)
-             positional_args.append(arg)
-
-        return (positional_args, kw_args)
-        
-
-
-
-def fragmentize(text,wiki_elements, element_store, environ, remove_escapes=True):
-
-    """Takes a string of wiki markup and outputs a list of genshi
-    Fragments (Elements and strings).
-
-    This recursive function, with help from the WikiElement objects,
-    does almost all the parsing.
-
-    When no WikiElement objects are supplied, escapes are removed from
-    ``text`` (except if remove_escapes=True)  and it is
-    returned as-is. This is the only way for recursion to stop.
-
-    :parameters:
-      text
-        the text to be parsed
-      wiki_elements
-        list of WikiElement objects to be searched for
-      environ
-        object that may by used by macros
-      remove_escapes
-        If False, escapes will not be removed
-    
-    """
-
-    while wiki_elements:
-        # If the first supplied wiki_element is actually a list of elements, \
-        # search for all of them and match the closest one only.
-        if isinstance(wiki_elements[0],(list,tuple)):
-            x = None
-            mos = None
-            for element in wiki_elements[0]:
-                mo = element.regexp.search(text)
-                if mo:
-                    if x is None or mo.start() < x:
-                        x,wiki_element,mos = mo.start(),element,[mo]
-        else:
-            wiki_element = wiki_elements[0]
-            mos = [mo for mo in wiki_element.regexp.finditer(text)]
-             
-        if mos:
-            frags = wiki_element._process(mos, text, wiki_elements, element_store, environ)
-            break
-        else:
-            wiki_elements = wiki_elements[1:]
-
-    # remove escape characters 
-    else: 
-        if remove_escapes:
-            text = esc_to_remove.sub('',text)
-        frags = fill_from_store(text,element_store)
-        
-    return frags
-
-
-def fill_from_store(text,element_store):
-    frags = []
-    mos = place_holder_re.finditer(text)
-    start = 0
-    for mo in mos:
-        if mo.start() > start:
-            frags.append(text[start:mo.start()])
-        frags.append(element_store.get(mo.group(1),
-                       mo.group(1).join(['<<<','>>>'])))
-        start = mo.end()
-    if start < len(text):
-        frags.append(text[start:])
-    return frags
-
-
-class ImplicitList(list):
-    """This class marks argument lists as implicit"""
-    pass
-
-_pattern = r"""
-    {(?:
-      (?P<escaped>{) |   # Escape sequence of two delimiters
-      (?P<named>[_a-z][_a-z0-9]*)}      |   # delimiter and a Python identifier
-      (?P<braced>[_a-z][_a-z0-9]*)}   |   # delimiter and a braced identifier
-      (?P<invalid>)              # Other ill-formed delimiter exprs
-    )
-    """
-
-class P3Template(string.Template):
-    pattern = _pattern
-    delimiter = '{'
-
-    def substitute(self, *args, **kws):
-        return super(P3Template,self).substitute(*args, **kws).replace('}}','}')
-
-
-def _test():
-    import doctest
-    doctest.testmod()
-
-if __name__ == "__main__":
-    _test()
-
+# core.py
+# -*- coding: utf-8 -*-
+#
+# Copyright © Stephen Day
+#
+# This module is part of Creoleparser and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+#
+
+import re, string
+import warnings
+import threading
+from collections import deque
+
+import genshi.builder as bldr
+from genshi.core import Stream, Markup, QName, Attrs
+
+from scanner import windowed, search, finditer
+
+__docformat__ = 'restructuredtext en'
+
+escape_char = '~'
+esc_neg_look = '(?<!' + re.escape(escape_char) + ')'
+esc_to_remove = re.compile(''.join([r'(?<!',re.escape(escape_char),')',re.escape(escape_char),r'(?!([ \n]|$))']))
+place_holder_re = re.compile(r'<<<(-?\d+?)>>>')
+
+
+class Parser(object):
+    
+    def __init__(self,dialect, method='xhtml', strip_whitespace=False, encoding='utf-8'):
+        """Constructor for Parser objects
+
+        :parameters:
+          dialect
+            Usually created using :func:`creoleparser.dialects.create_dialect`
+          method
+            This value is passed to Genshies Steam.render(). Possible values
+            include ``xhtml``, ``html``, ``xml``, and ``text``.
+          strip_whitespace
+            This value is passed to Genshies Steam.render().
+          encoding
+            This value is passed to Genshies Steam.render(). If ``None``, the ouput
+            will be a unicode object.
+            
+        """
+    
+        if isinstance(dialect,type):
+            self.dialect = dialect()
+        else:
+            warnings.warn("""
+'dialect' should be a type object.
+"""
+                  )
+            self.dialect = dialect
+        self.method = method
+        self.strip_whitespace = strip_whitespace
+        self.encoding=encoding
+
+
+    def parse(self,text,element_store=None,context='block', environ=None, preprocess=True):
+        """Returns a Genshi Fragment (basically a list of Elements and text nodes).
+
+        :parameters:
+          text
+            The text to be parsed.
+          context
+            This is useful for marco development where (for example) supression
+            of paragraph tags is desired. Can be 'inline', 'block', or a list
+            of WikiElement objects (use with caution).
+          element_store
+            Internal dictionary that's passed around a lot ;)
+          environ
+            This can be any type of object. It will be passed to ``macro_func``
+            unchanged (for a description of ``macro_func``, see
+            :func:`~creoleparser.dialects.create_dialect`).
+          preprocess
+            Passes text through preprocess method that replaces Windows style
+            line breaks.
+            
+        """
+        
+        if preprocess:
+            text = self.preprocess(text)
+
+        return self._parse(text, element_store, context, environ)
+
+    def _parse(self, text, element_store, context, environ, calls=None, replay=None):
+        """Parses preprocessed text, recording the macros called in calls
+        (if not None) and reusing the values of those in replay."""
+
+        if element_store is None:
+            element_store = {}
+        if not isinstance(context,list):
+            if context == 'block':
+                top_level_elements = self.dialect.block_elements
+            elif context == 'inline':
+                top_level_elements = self.dialect.inline_elements
+        else:
+            top_level_elements = context
+
+        previous = (getattr(_local, 'calls', None), getattr(_local, 'replay', None))
+        _local.calls, _local.replay = calls, replay
+        try:
+            return bldr.tag(fragmentize(text,top_level_elements,element_store, environ))
+        finally:
+            _local.calls, _local.replay = previous
+
+    def compile(self, text, context='block', environ=None, preprocess=True):
+        """Parses text into a :class:`ParseTree` (the first of two phases).
+
+        Returns a tuple of the tree (or None if text can't be represented
+        as one) and the Genshi Fragment :meth:`parse` would have returned.
+        Macros are called as usual. See :meth:`fill` for the second phase
+        and :meth:`parse` for the parameters; context must be 'block' or
+        'inline'.
+
+        >>> from dialects import create_dialect, creole11_base
+        >>> parser = Parser(create_dialect(creole11_base,
+        ...     macro_func=lambda name, args, body, isblock, environ: environ))
+        >>> tree, fragment = parser.compile("**<<now>>**", environ=bldr.tag.em(1))
+        >>> print fragment.generate(),
+        <p><strong><em>1</em></strong></p>
+        >>> print parser.fill(tree, environ=bldr.tag.em(2)).generate(),
+        <p><strong><em>2</em></strong></p>
+        >>> print parser.fill(tree, environ=u'//3//').generate(),
+        <p><strong><em>3</em></strong></p>
+
+        """
+
+        if preprocess:
+            text = self.preprocess(text)
+
+        calls = []
+        fragment = self._parse(text, None, context, environ, calls=calls)
+        try:
+            tree = ParseTree(text, context, calls, fragment,
+                             getattr(getattr(self.dialect, 'macro', None), 'func', None))
+        except ValueError:
+            tree = None
+        return tree, fragment
+
+    def fill(self, tree, environ=None):
+        """Returns the Genshi Fragment for a :class:`ParseTree` made by
+        :meth:`compile` (the second of two phases).
+
+        The macros of the tree are called again, in the same order. As long
+        as each returns a value that parses the same (see
+        :func:`macro_kind`), their values are filled into the holes the
+        tree has for them. Otherwise, the text of the tree is parsed again,
+        reusing the values of the macros called so far.
+
+        """
+
+        func = self.dialect.macro.func
+        replay = deque()
+        values = []
+        for args, kind in tree.calls:
+            value = func(*args + (environ,))
+            replay.append((args, value))
+            if macro_kind(value) != kind:
+                return self._parse(tree.text, None, tree.context, environ,
+                                   replay=replay)
+            values.append(value)
+
+        fragment = bldr.Fragment()
+        _decode(tree.nodes, values, fragment)
+        return fragment
+
+
+
+    def generate(self,text,element_store=None,context='block', environ=None, preprocess=True):
+        """Returns a Genshi Stream. See
+        :meth:`~creoleparser.core.Parser.parse` for named parameter descriptions.
+
+        """
+
+        return self.parse(text, element_store, context, environ, preprocess).generate()
+
+
+    def render(self, text, element_store=None, context='block', environ=None, preprocess=True, **kwargs):
+        """Returns the final output string (e.g., xhtml). See
+        :meth:`~creoleparser.core.Parser.parse` for named parameter descriptions.
+
+        Left over keyword arguments (``kwargs``) will be passed to Genshi's Stream.render() method,
+        overriding the corresponding attributes of the Parser object. For more infomation on Streams,
+        see the `Genshi documentation <http://genshi.edgewall.org/wiki/Documentation/streams.html#serialization-options>`_.
+        
+        """
+
+        kwargs.setdefault('method',self.method)
+        kwargs.setdefault('encoding',self.encoding)
+        if kwargs['method'] != "text":
+            kwargs.setdefault('strip_whitespace',self.strip_whitespace)
+        stream = self.generate(text, element_store, context, environ, preprocess)
+        return stream.render(**kwargs)
+
+    def __call__(self,text, **kwargs):
+        """Wrapper for the render method. Returns final output string.
+
+        """
+
+        return self.render(text, **kwargs)
+
+    def preprocess(self,text):
+        """This should generally be called before fragmentize().
+
+        :parameters:
+          text
+            text to be processsed.
+
+        """
+        text = text.replace("\r\n", "\n")
+        text = text.replace("\r", "\n")
+
+        return text    
+
+
+
+class ArgParser(object):
+    """Creates a callable object for parsing macro argument strings
+
+    >>> from dialects import creepy20_base
+    >>> my_parser = ArgParser(dialect=creepy20_base())
+    >>> my_parser(" one two foo='three' boo='four' ")
+    (['one', 'two'], {'foo': 'three', 'boo': 'four'})
+ 
+    A parser returns a two-tuple, the first item being a list of positional
+    arguments and the second a dictionary of keyword arguments. Argument
+    values are either strings or lists.
+    
+    """
+    
+    def __init__(self,dialect, convert_implicit_lists=True,
+                 arg_func=None, key_func=None, illegal_keys=(),
+                 convert_unicode_keys=True):
+        """Constructor for ArgParser objects
+
+        :parameters:
+          convert_unicode_keys
+            If *True*, keys will be converted using ``str(key)`` before being
+            added to the output dictionary. This allows the dictionary to be
+            safely passed to functions using the special ``**`` form (i.e.,
+            ``func(**kwargs)``).
+          dialect
+            Usually created using :func:`~creoleparser.dialects.creepy10_base`
+            or :func:`~creoleparser.dialects.creepy20_base`
+          convert_implicit_lists
+            If *True*, all implicit lists will be converted to strings
+            using ``' '.join(list)``. "Implicit" lists are created when
+            positional arguments follow keyword arguments
+            (see :func:`~creoleparser.dialects.creepy10_base`). 
+          illegal_keys
+            A tuple of keys that will be post-fixed with an underscore if found
+            during parsing. 
+          arg_func
+            If supplied, this function will be used to transform the values
+            of the positional arguments.
+          key_func
+            If supplied, this function will be used to transform the names
+            and values of keyword arguments. It must accept two positional
+            arguments. For example, this can be used to make keywords case
+            insensitive:
+            
+            >>> from string import lower
+            >>> from dialects import creepy20_base
+            >>> my_parser = ArgParser(dialect=creepy20_base(),
+            ...     key_func=lambda k, v: k, v.lower())
+            >>> my_parser(" Foo='one' ")
+            ([], {'foo': 'one'})
+            
+        """
+    
+        self.dialect = dialect()
+        self.convert_implicit_lists = convert_implicit_lists
+        self.arg_func = arg_func
+        self.key_func = key_func
+        self.illegal_keys = illegal_keys
+        self.convert_unicode_keys = convert_unicode_keys
+
+
+    def __call__(self, arg_string, **kwargs): 
+        """Parses the ``arg_string`` returning a two-tuple 
+
+        Keyword arguments (``kwargs``) can be used to override the corresponding
+        attributes of the ArgParser object (see above). However, the
+        ``dialect`` attribute **cannot** be overridden.
+        
+        """
+        
+        kwargs.setdefault('convert_implicit_lists',self.convert_implicit_lists)
+        kwargs.setdefault('arg_func',self.arg_func)
+        kwargs.setdefault('key_func',self.key_func)
+        kwargs.setdefault('illegal_keys',self.illegal_keys)
+        kwargs.setdefault('convert_unicode_keys',self.convert_unicode_keys)
+
+        return self._parse(arg_string,**kwargs)
+
+
+    def _parse(self,arg_string, convert_implicit_lists, arg_func, key_func,
+            illegal_keys, convert_unicode_keys):
+        
+        frags = fragmentize(arg_string,self.dialect.top_elements,{},{},
+                remove_escapes=False)
+        positional_args = []
+        kw_args = {}
+        for arg in frags:
+           if isinstance(arg,tuple):
+             k, v  = arg
+             if convert_unicode_keys:
+                 k = str(k)
+             if key_func:
+                 k, v =  key_func(k, v)
+             if k in illegal_keys:
+                 k = k + '_'
+             if k in kw_args:
+                if isinstance(v,list):
+                   try:
+                      kw_args[k].extend(v)
+                   except AttributeError:
+                      v.insert(0,kw_args[k])
+                      kw_args[k] = v
+                elif isinstance(kw_args[k],list):
+                   kw_args[k].append(v)
+                else:
+                   kw_args[k] = [kw_args[k], v]
+                kw_args[k] = ImplicitList(kw_args[k])
+             else:
+                kw_args[k] = v
+             if isinstance(kw_args[k],ImplicitList) and convert_implicit_lists:
+                 kw_args[k] = ' ' .join(kw_args[k])
+           else:
+             if arg_func:
+                 arg = arg_func(arg)
+             positional_args.append(arg)
+
+        return (positional_args, kw_args)
+        
+
+
+
+def fragmentize(text,wiki_elements, element_store, environ, remove_escapes=True,
+                pos=0, endpos=None):
+
+    """Takes a string of wiki markup and outputs a list of genshi
+    Fragments (Elements and strings).
+
+    This recursive function, with help from the WikiElement objects,
+    does almost all the parsing.
+
+    When no WikiElement objects are supplied, escapes are removed from
+    ``text`` (except if remove_escapes=True)  and it is
+    returned as-is. This is the only way for recursion to stop.
+
+    :parameters:
+      text
+        the text to be parsed
+      wiki_elements
+        list of WikiElement objects to be searched for
+      environ
+        object that may by used by macros
+      remove_escapes
+        If False, escapes will not be removed
+      pos, endpos
+        Only ``text[pos:endpos]`` is parsed. Unlike slicing ``text``, this
+        doesn't copy it (unless some of the elements can't search a window
+        of a text, see :func:`creoleparser.scanner.at_start`).
+    
+    """
+
+    if endpos is None:
+        endpos = len(text)
+    if pos and not windowed(tuple(wiki_elements)):
+        text, pos, endpos = text[pos:endpos], 0, endpos - pos
+
+    found = find_element(text, wiki_elements, pos, endpos)
+    if found:
+        wiki_elements, wiki_element, mos = found
+        frags = wiki_element._process(mos, text, wiki_elements, element_store, environ,
+                                      pos, endpos)
+
+    # remove escape characters 
+    else: 
+        if remove_escapes and text.find(escape_char, pos, endpos) != -1:
+            text = esc_to_remove.sub('',text[pos:endpos])
+            pos, endpos = 0, len(text)
+        frags = fill_from_store(text,element_store, pos, endpos)
+        
+    return frags
+
+
+def find_element(text, wiki_elements, pos=0, endpos=None):
+    """Finds the first of ``wiki_elements`` that matches ``text[pos:endpos]``.
+
+    Returns a tuple of ``wiki_elements`` from the element found on, the
+    element and its match objects, or None if no element matches.
+
+    """
+
+    while wiki_elements:
+        # If the first supplied wiki_element is actually a list of elements, \
+        # search for all of them and match the closest one only.
+        if isinstance(wiki_elements[0],(list,tuple)):
+            x = None
+            mos = None
+            for element in wiki_elements[0]:
+                mo = search(element.regexp, text, pos, endpos)
+                if mo:
+                    if x is None or mo.start() < x:
+                        x,wiki_element,mos = mo.start(),element,[mo]
+        else:
+            wiki_element = wiki_elements[0]
+            mos = finditer(wiki_element.regexp, text, pos, endpos)
+             
+        if mos:
+            return wiki_elements, wiki_element, mos
+        else:
+            wiki_elements = wiki_elements[1:]
+
+    return None
+
+
+_local = threading.local()
+
+
+def fill_from_store(text,element_store, pos=0, endpos=None):
+    if endpos is None:
+        endpos = len(text)
+    frags = []
+    mos = place_holder_re.finditer(text, pos, endpos)
+    start = pos
+    for mo in mos:
+        if mo.start() > start:
+            frags.append(text[start:mo.start()])
+        frags.append(element_store.get(mo.group(1),
+                       mo.group(1).join(['<<<','>>>'])))
+        start = mo.end()
+    if start < endpos:
+        frags.append(text[start:endpos])
+    return frags
+
+
+def call_macro(func, name, arg_string, body, isblock, environ):
+    """Calls the macro function func for a macro element, replaying or
+    recording the call if the parse is doing so (see :meth:`Parser.compile`)."""
+
+    args = (name, arg_string, body, isblock)
+    replay = getattr(_local, 'replay', None)
+    if replay and replay[0][0] == args:
+        value = replay.popleft()[1]
+    else:
+        value = func(name, arg_string, body, isblock, environ)
+
+    calls = getattr(_local, 'calls', None)
+    if calls is not None:
+        kind = macro_kind(value)
+        if isinstance(value, bldr.Fragment) and not isinstance(value, bldr.Element):
+            # The children of a Fragment are merged into its parent's, so mark
+            # where they start and end.
+            marked = bldr.Fragment()
+            marked.children = ([_Mark(len(calls))] + value.children +
+                               [_Mark(len(calls))])
+            value = marked
+        calls.append((args, kind, value, func))
+    return value
+
+
+def macro_kind(value):
+    """Returns what parsing depends on about a value returned by a macro:
+    the text of strings (which are parsed) and the type (and tag) of others.
+    """
+
+    if value is None:
+        return None
+    elif isinstance(value, Markup):
+        return ('markup',)
+    elif isinstance(value, basestring):
+        return value
+    elif isinstance(value, Stream):
+        return ('stream',)
+    elif isinstance(value, bldr.Element):
+        return ('element', unicode(value.tag))
+    elif isinstance(value, bldr.Fragment):
+        return ('fragment',)
+    return ('other', type(value).__name__)
+
+
+class _Mark(unicode):
+    """Empty text marking the children of a Fragment returned by a macro"""
+
+    def __new__(cls, index):
+        mark = unicode.__new__(cls)
+        mark.index = index
+        return mark
+
+
+class ParseTree(object):
+    """A parsed text with holes for the values of the macros in it.
+
+    Nodes are text, ``(markup,)`` tuples for Markup, ``(tag, attrs,
+    nodes)`` tuples for Elements and integers for holes, which index the
+    calls of the tree. Calls are tuples of the arguments of each macro
+    call (except ``environ``) and the kind of value it returned (see
+    :func:`macro_kind`). Trees can be pickled or marshalled.
+    """
+
+    def __init__(self, text, context, calls, fragment, func=None):
+        """Makes a tree from the calls recorded while parsing text into
+        fragment. Raises ValueError if that's not possible."""
+
+        if context not in ('block', 'inline'):
+            raise ValueError('context must be block or inline')
+
+        count, holes = 0, {}
+        for index, (args, kind, value, f) in enumerate(calls):
+            if f is not func:
+                raise ValueError('macros must use the macro function of the dialect')
+            if kind is None or isinstance(kind, basestring):
+                continue
+            count += 1
+            if isinstance(value, bldr.Element) or \
+                    not isinstance(value, bldr.Fragment):
+                if id(value) in holes:
+                    raise ValueError('a macro value is used twice')
+                holes[id(value)] = index
+
+        self.text = text
+        self.context = context
+        self.calls = [(args, kind) for args, kind, value, f in calls]
+        found = set()
+        self.nodes = _encode(fragment.children, holes, found)
+        if len(found) != count:
+            raise ValueError('a macro value is not part of the tree')
+
+
+def _encode(children, holes, found):
+    nodes = []
+    children = iter(children)
+    for child in children:
+        if isinstance(child, _Mark):
+            for end in children:
+                if isinstance(end, _Mark) and end.index == child.index:
+                    break
+            else:
+                raise ValueError('unbalanced macro value')
+            nodes.append(child.index)
+            found.add(child.index)
+        elif id(child) in holes:
+            nodes.append(holes[id(child)])
+            found.add(holes[id(child)])
+        elif isinstance(child, bldr.Element):
+            nodes.append((unicode(child.tag),
+                          tuple((unicode(name), value) for name, value in child.attrib),
+                          _encode(child.children, holes, found)))
+        elif isinstance(child, bldr.Fragment):
+            nodes.extend(_encode(child.children, holes, found))
+        elif isinstance(child, Markup):
+            nodes.append((unicode(child),))
+        elif isinstance(child, basestring):
+            nodes.append(child)
+        elif isinstance(child, Stream):
+            raise ValueError('streams can only be macro values')
+        else:
+            nodes.append(unicode(child))
+    return nodes
+
+
+def _decode(nodes, values, parent):
+    for node in nodes:
+        if isinstance(node, int):
+            parent.append(values[node])
+        elif isinstance(node, tuple):
+            if len(node) == 1:
+                parent.append(Markup(node[0]))
+            else:
+                element = bldr.Element(node[0])
+                element.attrib = Attrs([(QName(name), value)
+                                        for name, value in node[1]])
+                _decode(node[2], values, element)
+                parent.append(element)
+        else:
+            parent.append(node)
+
+
+class ImplicitList(list):
+    """This class marks argument lists as implicit"""
+    pass
+
+_pattern = r"""
+    {(?:
+      (?P<escaped>{) |   # Escape sequence of two delimiters
+      (?P<named>[_a-z][_a-z0-9]*)}      |   # delimiter and a Python identifier
+      (?P<braced>[_a-z][_a-z0-9]*)}   |   # delimiter and a braced identifier
+      (?P<invalid>)              # Other ill-formed delimiter exprs
+    )
+    """
+
+class P3Template(string.Template):
+    pattern = _pattern
+    delimiter = '{'
+
+    def substitute(self, *args, **kws):
+        return super(P3Template,self).substitute(*args, **kws).replace('}}','}')
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
+
@@ -16,7 +16,8 @@ import sys
 import genshi.builder as bldr
 from genshi.core import Stream, Markup
 
-from core import (escape_char, esc_neg_look, fragmentize, ImplicitList, P3Template) 
+from core import (escape_char, esc_neg_look, fragmentize, call_macro, ImplicitList,
+                  P3Template) 
 
 BLOCK_ONLY_TAGS = ['h1','h2','h3','h4','h5','h6',
               'ul','ol','dl',
@@ -27,7 +28,7 @@ BLOCK_ONLY_TAGS = ['h1','h2','h3','h4','h5','h6',
 BLOCK_TAGS = BLOCK_ONLY_TAGS + ['ins','del','script']
 
 
-MACRO_NAME = r'(?P<name>[a-zA-Z]+([-.]?[a-zA-Z0-9]+)*)'
+MACRO_NAME = r'(?P<name>[a-zA-Z][a-zA-Z0-9]*([-.][a-zA-Z0-9]+)*)'
 """allows any number of non-repeating hyphens or periods.
 Underscore is not included because hyphen is"""
 
@@ -94,9 +95,11 @@ class WikiElement(object):
             match object, usually the one returned by
             self.regexp.search(s) 
         """
-        return bldr.tag.__getattr__(self.tag)(fragmentize(mo.group(1),
+        return bldr.tag.__getattr__(self.tag)(fragmentize(mo.string,
                                                           self.child_elements,
-                                                          element_store, environ))
+                                                          element_store, environ,
+                                                          pos=mo.start(1),
+                                                          endpos=mo.end(1)))
 
     def re_string(self):
         """The regular expression pattern that is compiled into ``self.regexp``.
@@ -115,19 +118,23 @@ class WikiElement(object):
 
 
 
-    def _process(self, mos, text, wiki_elements,element_store, environ):
+    def _process(self, mos, text, wiki_elements,element_store, environ,
+                 pos=0, endpos=None):
         """Returns genshi Fragments (Elements and text)
 
         This is mainly for block level markup. See InlineElement
-        for the other method.
+        for the other method. Only ``text[pos:endpos]`` is processed.
         """
+        if endpos is None:
+            endpos = len(text)
         frags = []
-        end = 0
+        end = pos
         for mo in mos:
             if end != mo.start():
             # call again for leading text and extend the result list 
-                frags.extend(fragmentize(text[end:mo.start()],wiki_elements[1:],
-                                         element_store, environ))
+                frags.extend(fragmentize(text,wiki_elements[1:],
+                                         element_store, environ,
+                                         pos=end, endpos=mo.start()))
             # append the found wiki element to the result list
             built = self._build(mo,element_store, environ)
             if built is not None:
@@ -137,11 +144,12 @@ class WikiElement(object):
                 frags.append('\n')
             end = mo.end()
         # call again for trailing text and extend the result list
-        if end < len(text):
+        if end < endpos:
             if not isinstance(wiki_elements[0],(list,tuple)):
                 wiki_elements = wiki_elements[1:]
-            frags.extend(fragmentize(text[end:],wiki_elements,
-                                         element_store, environ))
+            frags.extend(fragmentize(text,wiki_elements,
+                                         element_store, environ,
+                                         pos=end, endpos=endpos))
 
         return frags
 
@@ -193,19 +201,22 @@ class InlineElement(WikiElement):
             content = '(.+?)'
             return esc_neg_look + re.escape(self.token[0]) + content + esc_neg_look + re.escape(self.token[1])
 
-    def _process(self, mos, text, wiki_elements, element_store, environ):
+    def _process(self, mos, text, wiki_elements, element_store, environ,
+                 pos=0, endpos=None):
         """Returns genshi Fragments (Elements and text)"""
+        if endpos is None:
+            endpos = len(text)
         parts = []
-        end = 0
+        end = pos
         for mo in mos:
             processed = self._build(mo,element_store, environ)
             store_id = str(id(processed)) 
             element_store[store_id] = processed
-            parts.append(''.join([text[end:mo.start()],'<<<',store_id,'>>>']))
+            parts.extend([text[end:mo.start()],'<<<',store_id,'>>>'])
             end = mo.end()
         # call again for trailing text and extend the result list
-        if end < len(text):
-            parts.append(text[end:])
+        if end < endpos:
+            parts.append(text[end:endpos])
         new_text = ''.join(parts)
         if not isinstance(wiki_elements[0],(list,tuple)):
             wiki_elements = wiki_elements[1:]
@@ -241,9 +252,11 @@ class SimpleElement(InlineElement):
             return esc_neg_look + tokens + content + end
 
     def _build(self,mo,element_store, environ):
-        return bldr.tag.__getattr__(self.token_dict[mo.group(1)])(fragmentize(mo.group(2),
+        return bldr.tag.__getattr__(self.token_dict[mo.group(1)])(fragmentize(mo.string,
                                                           self.child_elements,
-                                                          element_store, environ))
+                                                          element_store, environ,
+                                                          pos=mo.start(2),
+                                                          endpos=mo.end(2)))
 
 
 class LinkElement(InlineElement):
@@ -498,8 +511,11 @@ class Macro(WikiElement):
         self.regexp = re.compile(self.re_string())
 
 
-    def _process(self, mos, text, wiki_elements,element_store, environ):
+    def _process(self, mos, text, wiki_elements,element_store, environ,
+                 pos=0, endpos=None):
         """Returns genshi Fragments (Elements and text)"""
+        if endpos is None:
+            endpos = len(text)
         assert len(mos) == 1
         mo = mos[0]
         processed = self._build(mo,element_store, environ)
@@ -509,13 +525,13 @@ class Macro(WikiElement):
         else:
             tail = ''
         if isinstance(processed, basestring) and not isinstance(processed,Markup):
-            text = ''.join([text[:mo.start()],processed,tail,
-                        text[mo.end():]])
+            text = ''.join([text[pos:mo.start()],processed,tail,
+                        text[mo.end():endpos]])
         else:
             store_id = str(id(processed))
             element_store[store_id] = processed
-            text = ''.join([text[:mo.start()],'<<<',store_id,'>>>',tail,
-                        text[mo.end():]])
+            text = ''.join([text[pos:mo.start()],'<<<',store_id,'>>>',tail,
+                        text[mo.end():endpos]])
         frags = fragmentize(text,wiki_elements,element_store, environ)
         return frags
 
@@ -529,7 +545,7 @@ class Macro(WikiElement):
     def _build(self,mo,element_store, environ):
         arg_string = re.sub(self.trailing_slash,'',mo.group(4))
         if self.func:
-            value = self.func(mo.group('name'),arg_string,None,False,environ)
+            value = call_macro(self.func,mo.group('name'),arg_string,None,False,environ)
         else:
             value = None
         if value is None:
@@ -584,7 +600,8 @@ class BodiedMacro(Macro):
                 
         
         if self.func:
-            value = self.func(mo.group('name'),mo.group('arg_string'),body,False,environ)
+            value = call_macro(self.func,mo.group('name'),mo.group('arg_string'),body,False,
+                               environ)
         else:
             value = None
         if value is None:
@@ -624,12 +641,15 @@ class BodiedBlockMacro(WikiElement):
         return start + '(' + MACRO_NAME + arg_string + ')' + '(?<!/)' + \
                re.escape(self.token[1]) + r'\s*?\n' + body + end
 
-    def _process(self, mos, text, wiki_elements,element_store, environ):
+    def _process(self, mos, text, wiki_elements,element_store, environ,
+                 pos=0, endpos=None):
         """Returns genshi Fragments (Elements and text)
 
         This is mainly for block level markup. See InlineElement
         for the other method.
         """
+        if endpos is None:
+            endpos = len(text)
         assert len(mos) == 1
         mo = mos[0]
         processed = self._build(mo,element_store, environ)
@@ -640,25 +660,30 @@ class BodiedBlockMacro(WikiElement):
             tail = ''
         if isinstance(processed, basestring) and not isinstance(processed,Markup):
             #print '_process', repr(processed)
-            text = ''.join([text[:mo.start()],processed,tail,
-                        text[mo.end():]])
+            text = ''.join([text[pos:mo.start()],processed,tail,
+                        text[mo.end():endpos]])
             frags = fragmentize(text,wiki_elements,element_store, environ)
         else:
         
             frags = []
             # call again for leading text and extend the result list 
-            if mo.start():
-                frags.extend(fragmentize(text[:mo.start()],wiki_elements[1:],
-                                         element_store, environ))
+            if mo.start() > pos:
+                frags.extend(fragmentize(text,wiki_elements[1:],
+                                         element_store, environ,
+                                         pos=pos, endpos=mo.start()))
             # append the found wiki element to the result list
             frags.append(processed)
             # make the source output easier to read
             if self.append_newline:
                 frags.append('\n')
             # call again for trailing text and extend the result list
-            if tail or mo.end() < len(text):
-                frags.extend(fragmentize(tail + text[mo.end():],wiki_elements,
+            if tail:
+                frags.extend(fragmentize(tail + text[mo.end():endpos],wiki_elements,
                                          element_store, environ))
+            elif mo.end() < endpos:
+                frags.extend(fragmentize(text,wiki_elements,
+                                         element_store, environ,
+                                         pos=mo.end(), endpos=endpos))
         return frags
 
     def _build(self,mo,element_store, environ):
@@ -682,7 +707,8 @@ class BodiedBlockMacro(WikiElement):
             tail = ''
 
         if self.func:
-            value = self.func(mo.group('name'),mo.group('arg_string'),body,True,environ)
+            value = call_macro(self.func,mo.group('name'),mo.group('arg_string'),body,True,
+                               environ)
         else:
             value = None
         if value is None:
@@ -1001,9 +1027,11 @@ class ListItem(BlockElement):
                rest_of_item + look_ahead
 
     def _build(self,mo,element_store, environ):
-        return bldr.tag.__getattr__(self.tag)(fragmentize(mo.group(3),
+        return bldr.tag.__getattr__(self.tag)(fragmentize(mo.string,
                                                           self.child_elements,
-                                                          element_store, environ))
+                                                          element_store, environ,
+                                                          pos=mo.start(3),
+                                                          endpos=mo.end(3)))
 
 
 class NestedList(WikiElement):
@@ -1100,7 +1128,8 @@ class Paragraph(BlockElement):
         return r'^(.*?)\n?$' 
 
     def _build(self,mo,element_store, environ):
-        content = fragmentize(mo.group(1), self.child_elements, element_store, environ)
+        content = fragmentize(mo.string, self.child_elements, element_store, environ,
+                              pos=mo.start(1), endpos=mo.end(1))
         # Check each list item and record those that are block only
         block_only_frags = []
         for i,element in enumerate(content):
@@ -1156,9 +1185,11 @@ class Heading(BlockElement):
 
     def _build(self,mo,element_store, environ):
         heading_tag = self.tags[len(mo.group(1))-1]
-        return bldr.tag.__getattr__(heading_tag)(fragmentize(mo.group(2),
+        return bldr.tag.__getattr__(heading_tag)(fragmentize(mo.string,
                                                           self.child_elements,
-                                                          element_store, environ))
+                                                          element_store, environ,
+                                                          pos=mo.start(2),
+                                                          endpos=mo.end(2)))
 
 
 class Table(BlockElement):
@@ -1309,13 +1340,15 @@ class NoWikiElement(InlineElement):
     def _build(self,mo,element_store, environ):
         if self.tag:
             return bldr.tag.__getattr__(self.tag)(
-                   fragmentize(mo.group(1), self.child_elements,
+                   fragmentize(mo.string, self.child_elements,
                                element_store,environ,
-                               remove_escapes=False))
+                               remove_escapes=False,
+                               pos=mo.start(1), endpos=mo.end(1)))
         else:
-            return bldr.tag(fragmentize(mo.group(1),self.child_elements,
+            return bldr.tag(fragmentize(mo.string,self.child_elements,
                                         element_store, environ,
-                                        remove_escapes=False))
+                                        remove_escapes=False,
+                                        pos=mo.start(1), endpos=mo.end(1)))
 
     def re_string(self):
         if isinstance(self.token,str):
@@ -1419,27 +1452,31 @@ class BlankLine(WikiElement):
     def _build(self,mo,element_store, environ):
         return None
 
-    def _process(self, mos, text, wiki_elements,element_store, environ):
+    def _process(self, mos, text, wiki_elements,element_store, environ,
+                 pos=0, endpos=None):
         """Returns genshi Fragments (Elements and text)
 
         Custom _process method here just to avoid unnecessary calling of
         _build.
         """
         
+        if endpos is None:
+            endpos = len(text)
         frags = []
-        end = 0
+        end = pos
         for mo in mos:
             if end != mo.start():
             # call again for leading text and extend the result list 
-                frags.extend(fragmentize(text[end:mo.start()],wiki_elements[1:],
-                                         element_store, environ))
+                frags.extend(fragmentize(text,wiki_elements[1:],
+                                         element_store, environ,
+                                         pos=end, endpos=mo.start()))
             end = mo.end()
         # call again for trailing text and extend the result list
-        if end < len(text):
+        if end < endpos:
             if not isinstance(wiki_elements[0],(list,tuple)):
                 wiki_elements = wiki_elements[1:]
-            frags.extend(fragmentize(text[end:],wiki_elements,
-                 element_store, environ))
+            frags.extend(fragmentize(text,wiki_elements,
+                 element_store, environ, pos=end, endpos=endpos))
 
         return frags
 
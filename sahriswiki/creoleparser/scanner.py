@@ -0,0 +1,239 @@
+# scanner.py
+# -*- coding: utf-8 -*-
+#
+# Copyright © Stephen Day
+#
+# This module is part of Creoleparser and is released under
+# the MIT License: http://www.opensource.org/licenses/mit-license.php
+#
+
+"""Searching windows of a text.
+
+Lets the patterns of wiki elements search a window ``text[pos:endpos]``
+of a text without slicing it (see :func:`at_start`, :func:`search` and
+:func:`finditer`).
+
+"""
+
+import re
+import sre_parse
+import sre_constants as sre
+
+__docformat__ = 'restructuredtext en'
+
+
+def _tokens(pattern):
+    """Splits a regular expression pattern into tokens, keeping escapes,
+    character classes and group openings together."""
+
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            j = i + 2
+            while j < n and j < i + 4 and pattern[j-1].isdigit() and \
+                  pattern[j].isdigit():
+                j += 1
+            yield pattern[i:j]
+            i = j
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] == '^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                if pattern[j] == '\\':
+                    j += 1
+                j += 1
+            yield pattern[i:j+1]
+            i = j + 1
+        elif c == '(' and pattern.startswith('(?', i):
+            if pattern.startswith('(?P<', i):
+                j = pattern.index('>', i) + 1
+            elif pattern.startswith('(?P=', i):
+                j = pattern.index(')', i) + 1
+            elif pattern.startswith('(?<=', i) or pattern.startswith('(?<!', i):
+                j = i + 4
+            elif pattern[i+2:i+3] in (':', '=', '!'):
+                j = i + 3
+            else:
+                # (?#...), (?(id)...) and inline flags are not supported
+                raise ValueError('unsupported construct in %r' % pattern)
+            yield pattern[i:j]
+            i = j
+        else:
+            yield c
+            i += 1
+
+
+class _Unsafe(Exception):
+    """Raised when a pattern depends on the text before its window"""
+
+
+_CONTEXT = (sre.AT_BEGINNING, sre.AT_BEGINNING_STRING, sre.AT_BOUNDARY,
+            sre.AT_NON_BOUNDARY)
+
+def _check(items, start):
+    """Checks that parsed pattern items only look behind the position they
+    are evaluated at by one character, and not at all while possibly at
+    the start of the match if start is True.
+
+    Returns whether the items may still be at the start of the match.
+    Raises _Unsafe if the check fails.
+    """
+
+    for op, av in items:
+        if op == sre.AT:
+            if start and av in _CONTEXT:
+                raise _Unsafe()
+        elif op in (sre.ASSERT, sre.ASSERT_NOT):
+            direction, sub = av
+            if direction < 0:
+                if start or sub.getwidth() != (1, 1):
+                    raise _Unsafe()
+                _check(sub, True)
+            else:
+                _check(sub, start)
+        elif op == sre.SUBPATTERN:
+            start = _check(av[1], start)
+        elif op == sre.BRANCH:
+            start = max([_check(branch, start) for branch in av[1]])
+        elif op in (sre.MAX_REPEAT, sre.MIN_REPEAT):
+            after = _check(av[2], start)
+            if av[0]:
+                start = after
+        elif op == sre.GROUPREF_EXISTS:
+            raise _Unsafe()
+        elif op != sre.GROUPREF:
+            start = False
+    return start
+
+
+def _at_start(pattern):
+    """Returns pattern with its leading anchors and lookbehinds replaced by
+    what they evaluate to at the start of a text."""
+
+    tokens = list(_tokens(pattern))
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ('^', r'\A'):
+            tokens[i] = ''
+        elif token in ('(?<!', '(?<='):
+            depth, j = 1, i + 1
+            while depth:
+                if tokens[j].startswith('('):
+                    depth += 1
+                elif tokens[j] == ')':
+                    depth -= 1
+                tokens[j] = ''
+                j += 1
+            tokens[i] = token == '(?<=' and '(?!)' or ''
+            i = j - 1
+        else:
+            break
+        i += 1
+    return ''.join(tokens)
+
+
+_at_starts = {}
+
+def at_start(regexp):
+    r"""Returns a variant of the compiled pattern regexp that, matched at
+    pos, behaves like regexp matched at the start of ``text[pos:]``.
+
+    Returns None if regexp depends on the text before a window in other
+    ways than through leading anchors and lookbehinds, or looks back more
+    than one character.
+
+    >>> at_start(re.compile(r'(?<!~)\*\*')).pattern
+    '\\*\\*'
+    >>> at_start(re.compile(r'(?<=\n)^a', re.M)).pattern
+    '(?!)a'
+    >>> at_start(re.compile(r'a|^b', re.M)) is None
+    True
+
+    """
+
+    try:
+        return _at_starts[regexp]
+    except KeyError:
+        variant = None
+        try:
+            pattern = _at_start(regexp.pattern)
+            _check(sre_parse.parse(regexp.pattern, regexp.flags), False)
+            _check(sre_parse.parse(pattern, regexp.flags), True)
+            variant = re.compile(pattern, regexp.flags)
+        except (_Unsafe, ValueError, IndexError, re.error):
+            pass
+        _at_starts[regexp] = variant
+        return variant
+
+
+def search(regexp, text, pos=0, endpos=None):
+    """Returns ``regexp.search(text[pos:endpos])``, but without slicing text
+    and with match positions relative to text.
+
+    For pos > 0, :func:`at_start` must support regexp.
+
+    >>> search(re.compile('^b'), 'abc', 1).span()
+    (1, 2)
+
+    """
+
+    if endpos is None:
+        endpos = len(text)
+    if not pos:
+        return regexp.search(text, pos, endpos)
+    mo = at_start(regexp).match(text, pos, endpos)
+    if mo is None:
+        mo = regexp.search(text, pos + 1, endpos)
+    return mo
+
+
+def finditer(regexp, text, pos=0, endpos=None):
+    """Returns a list of the matches of ``regexp.finditer(text[pos:endpos])``
+    like :func:`search` does."""
+
+    if endpos is None:
+        endpos = len(text)
+    if not pos:
+        return list(regexp.finditer(text, pos, endpos))
+    mo = search(regexp, text, pos, endpos)
+    if mo is None:
+        return []
+    # finditer moves on by one character after an empty match.
+    return [mo] + list(regexp.finditer(text, mo.end() + (mo.end() ==
+                                                         mo.start()), endpos))
+
+
+_windowed = {}
+
+def windowed(wiki_elements):
+    """Returns whether all of wiki_elements (as in the ``wiki_elements``
+    argument of :func:`~creoleparser.core.fragmentize`) can search a
+    window of a text."""
+
+    try:
+        return _windowed[wiki_elements]
+    except (KeyError, TypeError):
+        result = True
+        for item in wiki_elements:
+            if not isinstance(item, (list, tuple)):
+                item = [item]
+            for element in item:
+                result = result and at_start(element.regexp) is not None
+        try:
+            _windowed[wiki_elements] = result
+        except TypeError:
+            pass
+        return result
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -39,17 +39,22 @@ class DatabaseManager(BaseComponent):
             )
         )
 
+    def create_tables(self):
+        """Create missing tables, populating them with their default data."""
+
+        tables = self.engine.table_names()
+        for Table, data in schema.DATA:
+            if Table.__tablename__ not in tables:
+                Table.__table__.create(self.engine)
+                for row in data:
+                    self.session.add(Table(*row))
+                self.session.commit()
+        metadata.create_all(self.engine)
+
     @handler("registered")
     def _on_registered(self, component, manager):
         if component == self:
-            tables = self.engine.table_names()
-            for Table, data in schema.DATA:
-                if Table.__tablename__ not in tables:
-                    Table.__table__.create(self.engine)
-                    for row in data:
-                        self.session.add(Table(*row))
-                    self.session.commit()
-            metadata.create_all(self.engine)
+            self.create_tables()
 
     @handler("stopped", channel="*")
     def _on_stopped(self, component):
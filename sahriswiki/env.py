@@ -8,16 +8,19 @@
 """
 
 import os
+from math import ceil
 from hashlib import md5
+from cPickle import PicklingError
 from urllib import basejoin
 from itertools import chain
 from urlparse import urlparse
+from contextlib import contextmanager
 from os.path import basename, dirname, relpath
 
-from circuits import handler, BaseComponent
+from circuits import handler, BaseComponent, Event
 
 from genshi.builder import tag
-from genshi.core import Markup
+from genshi.core import Markup, Stream
 from genshi.template import TemplateLoader
 
 from creoleparser import create_dialect, creole11_base, Parser
@@ -25,8 +28,11 @@ from creoleparser import create_dialect, creole11_base, Parser
 import macros
 import sahriswiki
 from utils import page_mime
+from throttle import TokenBuckets
+from cache import RenderCache, NotFoundCache
+from errors import NotFoundErr
 from auth import Permissions
-from search import WikiSearch
+from search import search_class
 from dbm import DatabaseManager
 from storage import WikiSubdirectoryIndexesStorage as DefaultStorage
 
@@ -34,6 +40,15 @@ from pagetypes import WikiPageText, WikiPageHTML
 from pagetypes import WikiPageWiki, WikiPageFile, WikiPageImage
 from pagetypes import WikiPageColorText, WikiPageCSV, WikiPageRST
 
+class RepositoryChanged(Event):
+    """Repository Changed Event
+
+    Fired with the list of changed page titles (or None if unknown)
+    whenever the tip of the repository moves.
+    """
+
+    name = "repository_changed"
+
 class Environment(BaseComponent):
 
     filename_map = {
@@ -74,12 +89,34 @@ class Environment(BaseComponent):
             charset=self.config.get("encoding"),
         )
 
-        self.search = WikiSearch(
+        self.storage.subscribe(self._on_repository_changed)
+
+        self.search = search_class(self.config, self.dbm.engine)(
             self.dbm.session,
             self.config.get("language"),
             self.storage,
         )
 
+        self.cache = RenderCache(
+            self.config.get("cache-size", 32) * 1024 * 1024,
+            self.config.get("cache-dir", None),
+        )
+
+        self.notfound_cache = NotFoundCache(
+            self.config.get("notfound-cache", 1000),
+        )
+
+        self.notfound_throttle = TokenBuckets(
+            self.config.get("notfound-rate", 1.0),
+            self.config.get("notfound-burst", 30),
+        )
+
+        # Dependencies (links, includes) of the renders in progress
+        self._dependencies = []
+
+        # Pages included by rendered not found pages (e.g. the site menu)
+        self._notfound_includes = set()
+
         self.parser = Parser(
             create_dialect(
                 creole11_base,
@@ -126,6 +163,20 @@ class Environment(BaseComponent):
         return self._login() or self.request.headers.get(
                 "X-Forwarded-For", self.request.remote.ip)
 
+    def _client(self):
+        """Address of the client, as told by a trusted proxy if behind one."""
+
+        ip = self.request.remote.ip
+        proxies = self.config.get("trusted-proxies") or ()
+        if isinstance(proxies, basestring):
+            proxies = proxies.split()
+        if ip in proxies:
+            forwarded = self.request.headers.get("X-Forwarded-For")
+            if forwarded:
+                # The last address is the one our proxy added.
+                return forwarded.split(",")[-1].strip()
+        return ip
+
     def _permissions(self):
         return Permissions(self, self._login())
 
@@ -197,7 +248,9 @@ class Environment(BaseComponent):
                 url = url[1:]
             if url and url[0] == "/":
                 url = url[1:]
-            if url in self.storage:
+            exists = url in self.storage
+            self._depend("links", url, bool(exists))
+            if exists:
                 return "wiki"
             else:
                 return "wiki new"
@@ -224,6 +277,140 @@ class Environment(BaseComponent):
                 return os.path.join(context["page"]["name"], path)
         return path
 
+    def _depend(self, kind, name, value):
+        for dependencies in self._dependencies:
+            dependencies[kind][name] = value
+
+    def _volatile(self):
+        for dependencies in self._dependencies:
+            dependencies["volatile"] = True
+
+    @contextmanager
+    def _tracking(self):
+        """Record the links and includes of what is rendered meanwhile,
+        and whether it is volatile (see _depend and _volatile)."""
+
+        dependencies = {"links": {}, "includes": {}, "volatile": False}
+        self._dependencies.append(dependencies)
+        try:
+            yield dependencies
+        finally:
+            self._dependencies.pop()
+
+    def _page_node(self, name):
+        try:
+            return self.storage.page_node(name)
+        except NotFoundErr:
+            return None
+
+    def _validate(self, entry):
+        """Check whether the links and includes of an entry still hold."""
+
+        for name, exists in entry["links"].iteritems():
+            if bool(name in self.storage) != exists:
+                return False
+
+        for name, node in entry["includes"].iteritems():
+            if self._page_node(name) != node:
+                return False
+
+        return True
+
+    def _cached(self, key, build, holes=False):
+        """Give the value in the render cache for key, or build it.
+
+        The links and includes build() depends on are kept with its
+        value, which is revalidated against them whenever the tip moves.
+        On hits they are passed on to the renders in progress. Values
+        are not cached if they are None, or if they are volatile unless
+        holes is True (they have holes for volatile macros).
+        """
+
+        if not (self.cache.size or self.cache.path):
+            return build()
+
+        tip = self.storage.repo_node()
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry["tip"] == tip or self._validate(entry):
+                if entry["tip"] != tip:
+                    entry["tip"] = tip
+                    self.cache.set(key, entry)
+                for kind in ("links", "includes"):
+                    for name, value in entry[kind].iteritems():
+                        self._depend(kind, name, value)
+                return entry["value"]
+            self.cache.discard(key)
+
+        with self._tracking() as dependencies:
+            value = build()
+
+        if value is not None and (holes or not dependencies["volatile"]):
+            entry = dict(dependencies, tip=tip, value=value)
+            try:
+                self.cache.set(key, entry)
+            except (PicklingError, TypeError):
+                pass
+
+        return value
+
+    def cached(self, name, node, render, data):
+        """Render page name at file node using the render cache.
+
+        render is only called on a cache miss. Cached entries are
+        revalidated against the existence of the pages they link to and
+        the nodes of the pages they include whenever the tip moves.
+        Changes render made to data (e.g. by SetTitle) are replayed.
+        """
+
+        def build():
+            before = data.copy()
+            events = list(render())
+            return events, dict((k, v) for k, v in data.iteritems()
+                    if k not in before or before[k] is not v)
+
+        key = (name, node, self.request.base, self.config.digest())
+        events, changes = self._cached(key, build)
+        data.update(changes)
+        return Stream(events)
+
+    def parse(self, name, text, data):
+        """Parse the wiki text of page name using cached parse trees.
+
+        Parse trees are cached by a hash of the text and revalidated like
+        the render cache. On hits only the macros of the page are run
+        again, so pages with request dependent macros (AddComment) skip
+        parsing too.
+        """
+
+        environ = (self, data)
+        fragments = []
+
+        def build():
+            tree, fragment = self.parser.compile(text, context="block",
+                    environ=environ)
+            fragments.append(fragment)
+            return tree
+
+        key = ("tree", md5(text.encode("utf-8")).hexdigest(), name,
+                self.request.base, self.config.digest())
+        # Volatile macros are run again on every fill.
+        tree = self._cached(key, build, holes=True)
+        if fragments:
+            return fragments[0].generate()
+        return self.parser.fill(tree, environ).generate()
+
+    def _on_repository_changed(self, titles):
+        # Not found pages include the site menu and other layout pages.
+        if titles is None or self._notfound_includes.intersection(titles):
+            self.notfound_cache.clear()
+        else:
+            for title in titles:
+                self.notfound_cache.discard(title)
+
+        self.fire(RepositoryChanged(titles))
+
     def uri(self, *args):
         return self.request.uri("/".join(args))
 
@@ -254,6 +441,8 @@ class Environment(BaseComponent):
 
     def include(self, name, parse=True, raw=False, context="block", data=None):
         if name in self.storage:
+            if self._dependencies:
+                self._depend("includes", name, self._page_node(name))
             text = self.storage.page_text(name)
             if parse:
                 return self.parser.generate(text, context=context,
@@ -264,8 +453,67 @@ class Environment(BaseComponent):
                 else:
                     return tag.pre(text)
         else:
+            self._depend("includes", name, None)
             return tag.div(tag.p(u"Page %s Not Found" % name), class_="error")
 
+    def notfound(self, name, query=None):
+        """Render the not found page for name, suggesting pages like query.
+
+        Renders are cached until a page called name is created or a page
+        they include (like the site menu) changes. Clients asking for too
+        many missing pages are told to slow down instead.
+        """
+
+        client = self._client()
+        if not self.notfound_throttle.consume(client):
+            wait = self.notfound_throttle.wait(client)
+            self.response.status = 429
+            self.response.headers["Retry-After"] = str(int(ceil(wait)))
+            self.response.headers["Content-Type"] = "text/plain"
+            return "Too many requests for missing pages"
+
+        self.response.status = 404
+
+        key = (name, self._login(), self.request.base)
+        body = self.notfound_cache.get(key)
+        if body is None:
+            data = {"title": name}
+            data["results"] = self.search.suggest(query or name)
+            if hasattr(self.storage, "page_parent"):
+                data["parent"] = self.storage.page_parent(name)
+
+            with self._tracking() as dependencies:
+                body = self.render("notfound.html", **data)
+
+            self._notfound_includes.update(dependencies["includes"])
+            self.notfound_cache.set(key, body)
+
+        return body
+
+    def template_include(self, name, *args, **kwargs):
+        """Include page name in a template as serialized markup.
+
+        Parsed includes are kept in the render cache by the file node of
+        the page and revalidated like rendered pages whenever the tip
+        moves.
+        """
+
+        if args or kwargs or name not in self.storage:
+            return self.include(name, *args, **kwargs)
+
+        node = self._page_node(name)
+        self._depend("includes", name, node)
+
+        def build():
+            result = self.include(name)
+            if not isinstance(result, Stream):
+                # An Element, e.g. when the page is gone meanwhile.
+                result = result.generate()
+            return Markup(result.render("xhtml", encoding=None))
+
+        key = ("include", name, node, self.request.base, self.config.digest())
+        return self._cached(key, build)
+
     def render(self, template, **data):
         data.update({
             "sahriswiki": {
@@ -273,7 +521,7 @@ class Environment(BaseComponent):
             },
             "uri":         self.uri,
             "site":        self.site,
-            "include":     self.include,
+            "include":     self.template_include,
             "config":      self.config,
             "staticuri":   self.staticuri,
             "permissions": self._permissions(),
@@ -288,3 +536,5 @@ class Environment(BaseComponent):
     def _on_request(self, request, response):
         self.request = request
         self.response = response
+
+        self.storage.refresh()
@@ -0,0 +1,73 @@
+# Module:   indexer
+
+"""Background Search Indexer
+
+Keeps the search index up to date with the repository in a background
+thread so that requests never wait for pending indexing work.
+"""
+
+import sys
+from traceback import format_exc
+from threading import Event, Thread
+
+from circuits import handler, BaseComponent
+
+
+class Indexer(BaseComponent):
+
+    def __init__(self, environ, interval=60):
+        super(Indexer, self).__init__()
+
+        self.environ = environ
+        self.interval = interval
+
+        self.search = self.environ.search
+        self.storage = self.environ.storage
+
+        self._running = False
+        self._thread = None
+        self._wakeup = Event()
+
+    def wakeup(self):
+        """Request the index to be updated as soon as possible."""
+
+        self._wakeup.set()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            try:
+                # Pick up changes made from outside (e.g. pushes) even if
+                # no requests are coming in.
+                self.storage.refresh()
+                self.search.update()
+                # Load the link graph ahead of the first request needing it.
+                self.search.link_graph()
+            except Exception:
+                self.search.rollback()
+                sys.stderr.write("ERROR: Error while indexing\n%s" % (
+                    format_exc(),))
+
+            self._wakeup.wait(self.interval)
+
+        self.search.db.remove()
+
+    @handler("started", channel="*")
+    def _on_started(self, component):
+        if self._thread is None:
+            self._running = True
+            self._thread = Thread(target=self._run, name="Indexer")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    @handler("stopped", channel="*")
+    def _on_stopped(self, component):
+        if self._thread is not None:
+            self._running = False
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+    @handler("repository_changed", channel="*")
+    def _on_repository_changed(self, titles):
+        self.wakeup()
@@ -67,10 +67,13 @@ def dispatcher(name, arg_string, body, isblock, (environ, data)):
     if name in environ.macros:
         macro = Macro(name, arg_string, body, isblock)
         args, kwargs = parse_args(arg_string)
+        if getattr(environ.macros[name], "volatile", False):
+            environ._volatile()
         try:
             return environ.macros[name](macro, environ, data,
                 *args, **kwargs)
         except Exception, e:
+            environ._volatile()
             error = "ERROR: Error while executing macro %s (%s)" % (name, e)
             traceback = format_exc()
             return tag.div(
@@ -129,9 +129,6 @@ def AddComment(macro, environ, data, *args, **kwargs):
         search = environ.search
         storage = environ.storage
 
-        storage.reopen()
-        search.update(environ)
-
         storage.save_text(page_name, new_text, author,
                 "Comment added by %s" % author)
 
@@ -177,6 +174,9 @@ def AddComment(macro, environ, data, *args, **kwargs):
 
     return tag(the_preview, the_comment, the_form)
 
+# The form depends on the request so pages using it are never cached.
+AddComment.volatile = True
+
 def source(macro, environ, data, *args, **kwargs):
     """Display the HTML source of some parsed wiki text
     
@@ -27,6 +27,8 @@ from circuits.web import Logger, Server, Sessions, Static
 from root import Root
 from config import Config
 from env import Environment
+from indexer import Indexer
+from reindex import reindex
 from tools import CacheControl, Compression
 from tools import ErrorHandler, SignalHandler
 
@@ -34,6 +36,9 @@ from tools import ErrorHandler, SignalHandler
 def main():
     config = Config()
 
+    if config.get("command") == "reindex":
+        return reindex(config)
+
     manager = Manager()
 
     if config.get("debug"):
@@ -45,6 +50,7 @@ def main():
     environ = Environment(config)
 
     SignalHandler(environ).register(environ)
+    Indexer(environ, config.get("index-interval")).register(environ)
 
     manager += environ
 
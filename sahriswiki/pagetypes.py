@@ -10,7 +10,6 @@
 import os
 import csv
 from StringIO import StringIO
-from operator import itemgetter
 from time import strftime, gmtime
 
 try:
@@ -143,9 +142,6 @@ class WikiPageText(WikiPage):
             data["html"] = self._render(text)
             return self.render("edit.html", **data)
         elif action == "save":
-            self.storage.reopen()
-            self.search.update(self.environ)
-
             self.storage.save_text(self.name, text, self.environ._user(),
                 comment, parent=parent)
             self.search.update_page(self, self.name, text=text)
@@ -179,7 +175,7 @@ class WikiPageWiki(WikiPageText):
 
     def _render(self, text=None, data={}):
         if text is None:
-            text = self._get_text()
+            return self.environ.parse(self.name, self._get_text(), data)
 
         return self.environ.parser.generate(text, context="block",
                 environ=(self.environ, data))
@@ -212,9 +208,6 @@ class WikiPageWiki(WikiPageText):
             data["html"] = self._render(text, data)
             return self.render("edit.html", **data)
         elif action == "save":
-            self.storage.reopen()
-            self.search.update(self.environ)
-
             self.storage.save_text(self.name, text, self.environ._user(),
                     comment, parent=parent)
             self.search.update_page(self, self.name, text=text)
@@ -228,7 +221,9 @@ class WikiPageWiki(WikiPageText):
             "page": self._get_page_data(),
             "ctxnav": self.environ._ctxnav("view", self.name),
         }
-        data["html"] = self._render(data=data)
+        node = self.storage.page_node(self.name)
+        data["html"] = self.environ.cached(self.name, node,
+                lambda: self._render(data=data), data)
         return self.render("view.html", **data)
 
 class WikiPageFile(WikiPage):
@@ -243,13 +238,8 @@ class WikiPageImage(WikiPageFile):
 
     def view(self):
         if self.name not in self.storage:
-            data = {"name": self.name}
-            self.storage.reopen()
-            self.search.update(self.environ)
             name, _ = os.path.splitext(self.name)
-            data["results"] = sorted(self.search.find((name,)),
-                    key=itemgetter(0), reverse=True)[:5]
-            return self.render("notfound.html", **data)
+            return self.environ.notfound(self.name, name)
 
         data = {
             "title": self.name,
@@ -306,9 +296,6 @@ class WikiPageCSV(WikiPageFile):
             }
             return self.render("edit.html", **data)
         elif action == "save":
-            self.storage.reopen()
-            self.search.update(self.environ)
-
             self.storage.save_text(self.name, text, self.environ._user(), comment,
                     parent=parent)
             self.search.update_page(self, self.name, text=text)
@@ -367,9 +354,6 @@ class WikiPageRST(WikiPageText):
             }
             return self.render("edit.html", **data)
         elif action == "save":
-            self.storage.reopen()
-            self.search.update(self.environ)
-
             self.storage.save_text(self.name, text, self.environ._user(),
                     comment, parent=parent)
             self.search.update_page(self, self.name, text=text)
@@ -432,9 +416,6 @@ class WikiPageHTML(WikiPageText):
             data["html"] = self._render(text)
             return self.render("edit.html", **data)
         elif action == "save":
-            self.storage.reopen()
-            self.search.update(self.environ)
-
             self.storage.save_text(self.name, text, self.environ._user(),
                 comment, parent=parent)
             self.search.update_page(self, self.name, text=text)
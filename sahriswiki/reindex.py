@@ -0,0 +1,95 @@
+# Module:   reindex
+
+"""Offline Search Reindexing
+
+Rebuilds the search index from scratch (``sahriswiki reindex``). Pages
+are tokenized by a pool of worker processes and written by a single
+writer. Only the search tables are rebuilt, in place, so users, sessions
+and permissions written meanwhile by a running server are kept. A running
+server reloads its in memory title and link indexes when restarted.
+"""
+
+import sys
+from time import time
+from multiprocessing import Pool
+
+# schema before dbm, which imports it back
+import schema
+from dbm import DatabaseManager
+from search import WikiSearch, search_class
+from utils import extract_links
+from errors import NotFoundErr
+from storage import WikiSubdirectoryIndexesStorage as DefaultStorage
+
+# Per worker process storage and tokenizer (see _init)
+_storage = None
+_search = None
+
+def _init(config):
+    global _storage, _search
+
+    _storage = DefaultStorage(config, config.get("repo"),
+            charset=config.get("encoding"))
+    _search = WikiSearch(None, config.get("language"), _storage)
+
+def _tokenize(title):
+    """Read and tokenize a page in a worker process."""
+
+    try:
+        text = _storage.page_text(title)
+    except NotFoundErr:
+        return title, None, {}, {}, []
+
+    return title, text, _search.page_words(title, text), \
+            _search.word_occurrences(text), list(extract_links(text))
+
+def reindex(config, out=sys.stderr):
+    storage = DefaultStorage(config, config.get("repo"),
+            charset=config.get("encoding"))
+
+    rev = storage.repo_revision()
+    pages = sorted(set(storage.all_pages()))
+
+    # Fork the workers before the database is opened.
+    pool = Pool(config.get("jobs"), _init, (config,))
+
+    dbm = DatabaseManager(config.get("db"))
+    dbm.create_tables()
+
+    search = search_class(config, dbm.engine)(dbm.session,
+            config.get("language"), storage)
+
+    try:
+        search.reset()
+
+        start = last = time()
+        results = pool.imap_unordered(_tokenize, pages, chunksize=16)
+        for i, (title, text, words, occurrences, links) in \
+                enumerate(results):
+            search.update_links(title, links)
+            search.update_words(title, text, words, occurrences)
+
+            if (i + 1) % 100 == 0:
+                dbm.session.commit()
+
+            now = time()
+            if now - last >= 1 or i + 1 == len(pages):
+                last = now
+                out.write("\r%d/%d pages (%.1f pages/s)" % (i + 1,
+                    len(pages), (i + 1) / max(now - start, 0.001)))
+                out.flush()
+
+        search.set_last_revision(rev)
+        dbm.session.commit()
+    except:
+        dbm.session.rollback()
+        pool.terminate()
+        raise
+    finally:
+        dbm.session.remove()
+        dbm.engine.dispose()
+
+    pool.close()
+    pool.join()
+
+    out.write("\nIndexed %d pages up to revision %d\n" % (len(pages), rev))
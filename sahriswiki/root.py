@@ -8,7 +8,8 @@
 """
 
 import os
-import re
+import json
+from urllib import urlencode
 from urlparse import urlparse
 from operator import itemgetter
 from difflib import unified_diff
@@ -27,6 +28,14 @@ from errors import ForbiddenErr, NotFoundErr
 
 class Root(BaseController):
 
+    # Default and largest number of search results shown on a page
+    search_limit = 20
+    search_max_limit = 100
+
+    # Default and largest number of titles completed
+    complete_limit = 10
+    complete_max_limit = 100
+
     def __init__(self, environ):
         super(Root, self).__init__()
 
@@ -53,12 +62,7 @@ class Root(BaseController):
         try:
             return page.view()
         except NotFoundErr:
-            data = {"title": name}
-            data["results"] = sorted(self.search.find((name,)),
-                    key=itemgetter(0), reverse=True)[:5]
-            if hasattr(self.storage, "page_parent"):
-                data["parent"] = self.storage.page_parent(name)
-            return self.render("notfound.html", **data)
+            return self.environ.notfound(name)
 
     @expose("+download")
     def download(self, *args, **kwargs):
@@ -94,7 +98,6 @@ class Root(BaseController):
                     author = self.request.headers.get("X-Forwarded-For",
                             self.request.remote.ip or "AnonymousUser")
 
-                self.storage.reopen()
                 self.storage.save_data(filename, filedata, author, comment)
 
         return self.render("upload.html", **data)
@@ -159,33 +162,14 @@ class Root(BaseController):
     @expose("+search")
     def search(self, *args, **kwargs):
 
-        def snippet(name, words):
-            """Extract a snippet of text for search results."""
-
-            try:
-                text = unicode(self.storage.open_page(name).read(),
-                    "utf-8", errors="replace")
-            except NotFoundErr:
-                return u""
-
-            regexp = re.compile(u"|".join(re.escape(w) for w in words),
-                    re.U | re.I)
-            match = regexp.search(text)
-            if match is None:
-                return u""
-            position = match.start()
-            min_pos = max(position - 60, 0)
-            max_pos = min(position + 60, len(text))
-            highlighted = "<span class=\"highlight\">%s</span>" % match.group(0)
-            return regexp.sub(highlighted, text[min_pos:max_pos])
-
-        def search(words):
-            self.storage.reopen()
-            self.search.update(self.environ)
-            results = list(self.search.find(words))
-            results.sort(key=itemgetter(0), reverse=True)
-            for score, name in results:
-                yield score, name, Markup(snippet(name, words))
+        def search(words, limit, offset):
+            for score, name in self.search.find(words, limit, offset):
+                yield score, name, Markup(self.search.snippet(name, words))
+
+        def search_uri(query, limit, offset):
+            return self.environ.uri("/+search?%s" % urlencode([
+                ("q", query.encode("utf-8")), ("limit", limit),
+                ("offset", offset)]))
 
         query = kwargs.get("q", None)
         if query is not None:
@@ -206,27 +190,57 @@ class Root(BaseController):
         if query in self.storage:
             return self.redirect(query)
 
-        words = tuple(self.search.split_text(query, stop=False))
+        words = self.search.parse_query(query)
         if not words:
             words = (query,)
 
+        try:
+            limit = int(kwargs.get("limit", self.search_limit))
+            offset = int(kwargs.get("offset", 0))
+        except ValueError:
+            limit, offset = self.search_limit, 0
+        limit = min(max(limit, 1), self.search_max_limit)
+        offset = max(offset, 0)
+
+        total = self.search.count(words)
+
         data = {
             "title": "Search results for \"%s\"" % query,
             "name": "Search",
             "query": query,
-            "results": list(search(words)),
+            "lag": self.search.lag(),
+            "total": total,
+            "offset": offset,
+            "results": list(search(words, limit, offset)),
+            "prev": None,
+            "next": None,
             "ctxnav": self.environ._ctxnav("search"),
         }
 
+        if offset > 0:
+            data["prev"] = search_uri(query, limit, max(offset - limit, 0))
+        if offset + limit < total:
+            data["next"] = search_uri(query, limit, offset + limit)
+
         return self.render("search.html", **data)
 
+    @expose("+complete")
+    def complete(self, *args, **kwargs):
+        prefix = kwargs.get("q", "")
+
+        try:
+            limit = int(kwargs.get("limit", self.complete_limit))
+        except ValueError:
+            limit = self.complete_limit
+        limit = min(max(limit, 1), self.complete_max_limit)
+
+        self.response.headers["Content-Type"] = "application/json"
+        return json.dumps(self.search.complete(prefix, limit))
+
     @expose("+backlinks")
     def backlinks(self, *args, **kwargs):
         name = os.path.sep.join(args)
 
-        self.storage.reopen()
-        self.search.update(self.environ)
-
         data = {
             "title": "BackLinks for \"%s\"" % name,
             "pages": sorted(self.search.page_backlinks(name),
@@ -282,9 +296,6 @@ class Root(BaseController):
 
     @expose("+orphaned")
     def orphaned(self, *args, **kwargs):
-        self.storage.reopen()
-        self.search.update(self.environ)
-
         data = {
             "title": "Orphaned Pages",
             "pages": sorted(self.search.orphaned_pages(), key=itemgetter(0)),
@@ -295,9 +306,6 @@ class Root(BaseController):
 
     @expose("+wanted")
     def wanted(self, *args, **kwargs):
-        self.storage.reopen()
-        self.search.update(self.environ)
-
         data = {
             "title": "Wanted Pages",
             "pages": sorted(self.search.wanted_pages(),
@@ -349,17 +357,27 @@ class Root(BaseController):
             "Disallow: /%2B",
         ))
 
+    @expose("+stats")
+    def stats(self, *args, **kwargs):
+        self.response.headers["Content-Type"] = "text/plain"
+
+        stats = dict(("cache.%s" % key, value)
+                for key, value in self.environ.cache.stats().iteritems())
+        stats.update(("notfound.%s" % key, value) for key, value in
+                self.environ.notfound_cache.stats().iteritems())
+        stats["notfound.denied"] = self.environ.notfound_throttle.denied
+        stats["search.lag"] = self.search.lag()
+
+        return "\r\n".join(
+            "%s: %s" % (key, stats[key]) for key in sorted(stats)
+        )
+
     @expose("+delete")
     def delete(self, *args, **kwargs):
         name = os.path.sep.join(args)
 
         if name not in self.storage:
-            data = {"title": name}
-            data["results"] = sorted(self.search.find((name,)),
-                    key=itemgetter(0), reverse=True)[:5]
-            if hasattr(self.storage, "page_parent"):
-                data["parent"] = self.storage.page_parent(name)
-            return self.render("notfound.html", **data)
+            return self.environ.notfound(name)
 
         action = kwargs.get("action", None)
 
@@ -370,9 +388,6 @@ class Root(BaseController):
         if action == "delete":
             comment = kwargs.get("comment", "")
 
-            self.storage.reopen()
-            self.search.update(self.environ)
-
             self.storage.delete_page(name, self.environ._user(), comment)
             self.search.update_page(self, name)
 
@@ -386,12 +401,7 @@ class Root(BaseController):
         name = os.path.sep.join(args)
 
         if name not in self.storage:
-            data = {"title": name}
-            data["results"] = sorted(self.search.find((name,)),
-                    key=itemgetter(0), reverse=True)[:5]
-            if hasattr(self.storage, "page_parent"):
-                data["parent"] = self.storage.page_parent(name)
-            return self.render("notfound.html", **data)
+            return self.environ.notfound(name)
 
         action = kwargs.get("action", None)
 
@@ -404,9 +414,6 @@ class Root(BaseController):
             if newname and newname not in self.storage:
                 comment = kwargs.get("comment", "")
 
-                self.storage.reopen()
-                self.search.update(self.environ)
-
                 user = self.environ._user()
 
                 text = self.storage.page_text(name)
@@ -9,11 +9,20 @@
 """
 
 import re
+from math import log
+from operator import add, itemgetter
+from itertools import groupby, islice
+from bisect import bisect_left, insort
+from threading import Lock, RLock
 
-from sqlalchemy import func, exists
+from sqlalchemy import func, exists, and_, or_, case, desc, bindparam
+from sqlalchemy import inspect, MetaData, Table
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import Column, ForeignKey, Integer, Sequence, String
+from sqlalchemy import Column, ForeignKey, Integer, Sequence, String, Text
+from sqlalchemy import LargeBinary
+
+from genshi.core import escape
 
 import schema
 from i18n import _
@@ -27,6 +36,7 @@ class Title(Base):
 
     id = Column(Integer, Sequence("titles_id_seq"), primary_key=True)
     title = Column(String(50))
+    length = Column(Integer)
 
     def __init__(self, title):
         self.title = title
@@ -34,22 +44,70 @@ class Title(Base):
     def __repr__(self):
         return "<Title('%s')>" % self.title
 
-class Word(Base):
+class Term(Base):
+
+    __tablename__ = "terms"
+
+    id = Column(Integer, Sequence("terms_id_seq"), primary_key=True)
+    term = Column(String(50), unique=True, index=True)
+    df = Column(Integer)
 
-    __tablename__ = "words"
+    def __init__(self, term, df=0):
+        self.term = term
+        self.df = df
+
+    def __repr__(self):
+        return "<Term('%s', %d)>" % (self.term, self.df)
 
-    id = Column(Integer, Sequence("words_id_seq"), primary_key=True)
-    word = Column(String(50), index=True)
-    page = Column(Integer, ForeignKey("titles.title"), index=True)
+class Posting(Base):
+
+    __tablename__ = "postings"
+
+    term = Column(Integer, ForeignKey("terms.id"), primary_key=True)
+    page = Column(Integer, ForeignKey("titles.id"), primary_key=True,
+            index=True)
     count = Column(Integer)
+    position = Column(Integer)
+    positions = Column(LargeBinary)
 
-    def __init__(self, word, page, count):
-        self.word = word
+    def __init__(self, term, page, count, position=None, positions=None):
+        self.term = term
         self.page = page
         self.count = count
+        self.position = position
+        self.positions = positions
+
+    def __repr__(self):
+        return "<Posting(%d, %d, %d)>" % (self.term, self.page, self.count)
+
+class PageText(Base):
+
+    __tablename__ = "texts"
+
+    page = Column(Integer, ForeignKey("titles.id"), primary_key=True)
+    text = Column(Text)
+
+    def __init__(self, page, text):
+        self.page = page
+        self.text = text
+
+    def __repr__(self):
+        return "<PageText('%s')>" % self.page
+
+class Trigram(Base):
+
+    __tablename__ = "trigrams"
+
+    gram = Column(String(3), primary_key=True)
+    term = Column(Integer, ForeignKey("terms.id"), primary_key=True,
+            index=True)
+
+    def __init__(self, gram, term):
+        self.gram = gram
+        self.term = term
 
     def __repr__(self):
-        return "<Word('%s', '%s', %d)>" % (self.word, self.page, self.count)
+        return "<Trigram('%s', %d)>" % (self.gram, self.term)
 
 class Link(Base):
 
@@ -71,6 +129,363 @@ class Link(Base):
         return "<Link('%s', '%s', '%s', %d)>" % (self.src, self.target,
                 self.label, self.number)
 
+class TitleIndex(object):
+    """
+    In-memory index of page titles: their trigrams, suggesting existing
+    pages with titles similar to a missing one, and a sorted array of
+    them for completing titles. Titles are kept as unicode, byte strings
+    are decoded with charset.
+    """
+
+    # Longest part of a title looked at, and most index entries visited,
+    # bounding the time taken by a lookup.
+    max_length = 100
+    max_postings = 5000
+
+    # Least similarity (Dice coefficient of the trigrams) of suggestions
+    min_score = 0.3
+
+    def __init__(self, charset="utf-8"):
+        super(TitleIndex, self).__init__()
+
+        self.charset = charset
+        self.loaded = False
+
+        self._lock = Lock()
+        self._grams = {}   # trigram -> titles
+        self._titles = {}  # title -> number of trigrams
+        self._sorted = []  # (lower case title, title), sorted
+
+    def _unicode(self, title):
+        if isinstance(title, unicode):
+            return title
+        return unicode(title, self.charset, "replace")
+
+    def _trigrams(self, title):
+        title = u" %s " % title.lower()[:self.max_length]
+        return set(title[i:i+3] for i in xrange(len(title) - 2))
+
+    def clear(self):
+        """Forget the index, it is loaded again when needed."""
+
+        with self._lock:
+            self.loaded = False
+            self._grams = {}
+            self._titles = {}
+            self._sorted = []
+
+    def load(self, titles):
+        self.clear()
+
+        with self._lock:
+            for title in titles:
+                self._add(self._unicode(title), False)
+            self._sorted.sort()
+            self.loaded = True
+
+    def _add(self, title, sort=True):
+        if title in self._titles:
+            return
+        grams = self._trigrams(title)
+        for gram in grams:
+            self._grams.setdefault(gram, set()).add(title)
+        self._titles[title] = len(grams)
+
+        if sort:
+            insort(self._sorted, (title.lower(), title))
+        else:
+            self._sorted.append((title.lower(), title))
+
+    def _remove(self, title):
+        if title not in self._titles:
+            return
+        for gram in self._trigrams(title):
+            titles = self._grams[gram]
+            titles.discard(title)
+            if not titles:
+                del self._grams[gram]
+        del self._titles[title]
+
+        key = (title.lower(), title)
+        i = bisect_left(self._sorted, key)
+        if i < len(self._sorted) and self._sorted[i] == key:
+            del self._sorted[i]
+
+    def add(self, title):
+        with self._lock:
+            if self.loaded:
+                self._add(self._unicode(title))
+
+    def remove(self, title):
+        with self._lock:
+            if self.loaded:
+                self._remove(self._unicode(title))
+
+    def similar(self, title, limit=5):
+        """Gives (score, title) of up to limit titles most similar to title."""
+
+        title = self._unicode(title)
+        grams = self._trigrams(title)
+        shared = {}
+
+        with self._lock:
+            # Rare trigrams say the most, visit them first.
+            postings = sorted((self._grams.get(gram, ()) for gram in grams),
+                    key=len)
+            budget = self.max_postings
+            for titles in postings:
+                if len(titles) > budget:
+                    break
+                budget -= len(titles)
+                for other in titles:
+                    shared[other] = shared.get(other, 0) + 1
+
+            scores = [(2.0 * count / (len(grams) + self._titles[other]),
+                other) for other, count in shared.iteritems()]
+
+        scores = [(score, other) for score, other in scores
+                if score >= self.min_score and other != title]
+        scores.sort(key=lambda x: (-x[0], x[1]))
+        return [(int(100 * score), other) for score, other in scores[:limit]]
+
+    def complete(self, prefix, limit=10):
+        """Gives up to limit titles starting with prefix, ignoring case."""
+
+        prefix = self._unicode(prefix).lower()
+        titles = []
+        with self._lock:
+            i = bisect_left(self._sorted, (prefix,))
+            for key, title in self._sorted[i:i+limit]:
+                if not key.startswith(prefix):
+                    break
+                titles.append(title)
+        return titles
+
+class LinkGraph(object):
+    """
+    In-memory graph of the links between pages, mirroring the links
+    table, so that backlinks, orphaned and wanted pages are answered
+    without querying the database.
+    """
+
+    def __init__(self):
+        super(LinkGraph, self).__init__()
+
+        self.loaded = False
+
+        self._lock = Lock()
+        self._titles = set()
+        self._links = {}      # src -> targets, in order
+        self._backlinks = {}  # target -> {src: number of links}
+        self._orphaned = set()
+        self._wanted = {}     # missing target -> number of links
+
+    def clear(self):
+        """Forget the graph, it is loaded again when needed."""
+
+        with self._lock:
+            self.loaded = False
+            self._titles = set()
+            self._links = {}
+            self._backlinks = {}
+            self._orphaned = set()
+            self._wanted = {}
+
+    def load(self, titles, links):
+        """Build the graph from all titles and (src, target) links."""
+
+        self.clear()
+
+        with self._lock:
+            for title in titles:
+                self._add_title(title)
+            for src, target in links:
+                self._links.setdefault(src, []).append(target)
+                self._add_link(src, target)
+            self.loaded = True
+
+    def _add_title(self, title):
+        self._titles.add(title)
+        if title in self._wanted:
+            del self._wanted[title]
+        elif title not in self._backlinks:
+            self._orphaned.add(title)
+
+    def _add_link(self, src, target):
+        sources = self._backlinks.setdefault(target, {})
+        sources[src] = sources.get(src, 0) + 1
+        if target in self._titles:
+            self._orphaned.discard(target)
+        else:
+            self._wanted[target] = self._wanted.get(target, 0) + 1
+
+    def _remove_link(self, src, target):
+        sources = self._backlinks[target]
+        sources[src] -= 1
+        if not sources[src]:
+            del sources[src]
+        if not sources:
+            del self._backlinks[target]
+
+        if target in self._titles:
+            if target not in self._backlinks:
+                self._orphaned.add(target)
+        else:
+            self._wanted[target] -= 1
+            if not self._wanted[target]:
+                del self._wanted[target]
+
+    def add_title(self, title):
+        with self._lock:
+            if self.loaded and title not in self._titles:
+                self._add_title(title)
+
+    def remove_title(self, title):
+        with self._lock:
+            if not self.loaded or title not in self._titles:
+                return
+            self._titles.remove(title)
+            self._orphaned.discard(title)
+            sources = self._backlinks.get(title)
+            if sources:
+                self._wanted[title] = sum(sources.itervalues())
+
+    def set_links(self, src, targets):
+        """Replace the links of page src."""
+
+        with self._lock:
+            if not self.loaded:
+                return
+            for target in self._links.pop(src, ()):
+                self._remove_link(src, target)
+            if targets:
+                self._links[src] = list(targets)
+                for target in targets:
+                    self._add_link(src, target)
+
+    def backlinks(self, title):
+        with self._lock:
+            return sorted(self._backlinks.get(title, ()))
+
+    def orphaned(self):
+        with self._lock:
+            return sorted(self._orphaned)
+
+    def wanted(self):
+        with self._lock:
+            return sorted(((count, target) for target, count in
+                self._wanted.iteritems()), key=lambda x: -x[0])
+
+def encode_positions(occurrences):
+    """
+    Encodes the (token, offset) occurrences of a word as the deltas to
+    the previous occurrence, in variable length integers.
+    """
+
+    data = bytearray()
+    last_token = last_offset = 0
+    for token, offset in occurrences:
+        for value in (token - last_token, offset - last_offset):
+            while value > 0x7f:
+                data.append(0x80 | (value & 0x7f))
+                value >>= 7
+            data.append(value)
+        last_token, last_offset = token, offset
+    return str(data)
+
+def decode_positions(data):
+    """Decodes the occurrences encoded by encode_positions."""
+
+    values = []
+    value = shift = 0
+    for byte in bytearray(data or ""):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+
+    occurrences = []
+    token = offset = 0
+    for i in xrange(0, len(values) - 1, 2):
+        token += values[i]
+        offset += values[i + 1]
+        occurrences.append((token, offset))
+    return occurrences
+
+class Phrase(object):
+    """
+    Words of a query to be found next to each other, in order. Stop
+    words are not indexed, only their place in the phrase is kept.
+    """
+
+    def __init__(self, text, words, terms):
+        self.text = text
+        self.words = words
+        self.terms = terms
+
+    def __repr__(self):
+        return "<Phrase(%r)>" % self.text
+
+    def matches(self, postings):
+        """
+        Gives the first token, last token and offset of each occurrence
+        of the phrase, from the occurrences of its words.
+        """
+
+        starts = None
+        for i, word in self.terms:
+            tokens = set(token - i for token, offset in postings.get(word, ()))
+            starts = tokens if starts is None else starts & tokens
+            if not starts:
+                return []
+
+        i, word = self.terms[0]
+        offsets = dict((token - i, offset)
+                for token, offset in postings[word])
+        return [(start, start + len(self.words) - 1, offsets[start])
+                for start in sorted(starts)]
+
+class Near(object):
+    """Phrases of a query to be found at most distance words apart."""
+
+    def __init__(self, phrases, distance=10):
+        self.phrases = phrases
+        self.distance = distance
+
+    def __repr__(self):
+        return "<Near(%r, %d)>" % (self.phrases, self.distance)
+
+    @property
+    def terms(self):
+        return [term for phrase in self.phrases for term in phrase.terms]
+
+    @property
+    def words(self):
+        return [word for phrase in self.phrases for word in phrase.words]
+
+    def matches(self, postings):
+        """Like Phrase.matches, giving the first match only."""
+
+        occurrences = sorted((start, end, offset, i)
+                for i, phrase in enumerate(self.phrases)
+                for start, end, offset in phrase.matches(postings))
+
+        # The closest preceding occurrence of each phrase
+        latest = {}
+        for start, end, offset, i in occurrences:
+            latest[i] = (start, end, offset)
+            if len(latest) < len(self.phrases):
+                continue
+            first = min(latest.itervalues())
+            last = max(end for start, end, offset in latest.itervalues())
+            between = last - first[0] + 1 - sum(end - start + 1
+                    for start, end, offset in latest.itervalues())
+            if between <= self.distance:
+                return [(first[0], last, first[2])]
+        return []
+
 class WikiSearch(object):
     """
     Responsible for indexing words and links, for fast searching and
@@ -79,11 +494,43 @@ class WikiSearch(object):
 
     word_pattern = re.compile(ur"""\w[-~&\w]+\w""", re.UNICODE)
 
+    query_pattern = re.compile(ur"""
+        "(?P<phrase>[^"]*)"?            # "exact phrase"
+        | (?P<near>NEAR)(/(?P<distance>\d+))?(?=\s|$)
+        | (?P<words>[^\s"]+)
+    """, re.UNICODE | re.VERBOSE)
+
+    # Bump whenever the index needs to be rebuilt from scratch. Indexes
+    # of other versions (including the unversioned words table of older
+    # releases) are dropped and rebuilt from the repository by update().
+    version = 6
+
+    # BM25 term frequency saturation and page length normalization
+    k1 = 1.2
+    b = 0.75
+
+    # Characters of text shown on either side of a search result's match
+    snippet_width = 60
+
     def __init__(self, db, lang, storage):
         self.db = db
         self.lang = lang
         self.storage = storage
 
+        # Serializes writes from requests and the background Indexer
+        self._lock = RLock()
+
+        self.links = LinkGraph()
+        self.titles = TitleIndex(
+                self.storage.charset if self.storage is not None else "utf-8")
+        if self.storage is not None:
+            self.storage.subscribe(self._on_pages_changed)
+
+        self._snippet_queries = {}
+
+        # Ids of terms, by term
+        self._term_ids = {}
+
         self.stop_words_re = re.compile(u'^('+u'|'.join(re.escape(_(
 u"""am ii iii per po re a about above
 across after afterwards again against all almost alone along already also
@@ -127,70 +574,358 @@ without would yet you your yours yourself yourselves""")).split())
             count[word] = count.get(word, 0)+1
         return count
 
+    def word_occurrences(self, text):
+        """
+        Gives the token number and offset of every occurrence of each word
+        in text. Stop words are counted as tokens, but left out.
+        """
+
+        occurrences = {}
+        for token, match in enumerate(self.word_pattern.finditer(text)):
+            word = match.group(0)
+            if not self.stop_words_re.match(word):
+                occurrences.setdefault(word.lower(), []).append(
+                        (token, match.start()))
+        return occurrences
+
+    def parse_query(self, query):
+        """
+        Splits a query into words, "exact phrases" and phrases to be
+        found NEAR (or NEAR/distance) each other.
+        """
+
+        terms = []
+        near = None
+        for match in self.query_pattern.finditer(query):
+            if match.group("near"):
+                if terms:
+                    near = int(match.group("distance") or 10)
+                continue
+
+            if match.group("phrase") is not None:
+                text = match.group("phrase")
+                words = list(self.split_text(text, stop=False))
+                items = [self._phrase(text, words)]
+                if not items[0].terms:
+                    continue
+            else:
+                # Plain words are matched anywhere inside indexed words.
+                items = list(self.split_text(match.group("words"),
+                    stop=False))
+                if not items:
+                    continue
+
+            # Stop words can't be looked for near others.
+            if near is not None and self._phrase(terms[-1]).terms \
+                    and self._phrase(items[0]).terms:
+                last, item = terms.pop(), self._phrase(items.pop(0))
+                if isinstance(last, Near):
+                    last.phrases.append(item)
+                else:
+                    last = Near([self._phrase(last), item], near)
+                terms.append(last)
+            near = None
+            terms.extend(items)
+
+        return tuple(terms)
+
+    def _phrase(self, text, words=None):
+        """Gives a Phrase of the words of text."""
+
+        if isinstance(text, (Phrase, Near)):
+            return text
+        if words is None:
+            words = [text]
+        return Phrase(text, words, [(i, word) for i, word in enumerate(words)
+            if not self.stop_words_re.match(word)])
+
+    def query_words(self, terms):
+        """Gives the words of query terms, for highlighting."""
+
+        words = []
+        for term in terms:
+            if isinstance(term, basestring):
+                words.append(term)
+            else:
+                words.extend(term.words)
+        return tuple(words)
+
+    def trigrams(self, word):
+        """Gives the set of all three letter substrings of a word."""
+
+        word = word.lower()
+        return set(word[i:i+3] for i in xrange(len(word) - 2))
+
+    def page_words(self, title, text):
+        """Counts the words of a page's text and title."""
+
+        if not text:
+            return {}
+        words = self.count_words(self.split_text(text))
+        title_words = self.count_words(self.split_text(title))
+        for word, count in title_words.iteritems():
+            words[word] = words.get(word, 0) + count
+        return words
+
     def title_id(self, title):
         try:
             return self.db.query(Title.id).filter(
                     Title.title==title).one().id
         except NoResultFound:
-            self.db.add(Title(title))
-            self.db.commit()
-            return self.db.query(Title.id).filter(
-                    Title.title==title).one().id
+            row = Title(title)
+            self.db.add(row)
+            self.db.flush()
+            self.links.add_title(title)
+            return row.id
+
+    def update_words(self, title, text, words=None, occurrences=None):
+        """
+        Updates the words of a page and their occurrences in its text,
+        only touching those that changed. The caller commits.
+        """
 
-    def update_words(self, title, text):
         title_id = self.title_id(title)
-        self.db.query(Word).filter(Word.page==title_id).delete()
-        if not text:
+        if words is None:
+            words = self.page_words(title, text)
+        if occurrences is None:
+            occurrences = self.word_occurrences(text) if words else {}
+
+        self.update_text(title_id, text)
+
+        new = {}
+        for word, count in words.iteritems():
+            if word in occurrences:
+                new[word] = (count, occurrences[word][0][1],
+                        encode_positions(occurrences[word]))
+            else:
+                # Only in the title
+                new[word] = (count, None, "")
+
+        old = dict((word, (term, count, position, positions))
+                for term, word, count, position, positions in
+                self.db.query(Posting.term, Term.term, Posting.count,
+                    Posting.position, Posting.positions).\
+                        filter(Posting.term==Term.id).\
+                        filter(Posting.page==title_id))
+
+        removed = [old[word][0] for word in old if word not in words]
+        changed = [{"_term": old[word][0], "_page": title_id,
+            "_count": count, "_position": position, "_positions": positions}
+                for word, (count, position, positions) in new.iteritems()
+                if word in old and old[word][1:] != (count, position,
+                    positions)]
+        ids = self.term_ids([word for word in new if word not in old],
+                create=True)
+        added = [{"term": ids[word], "page": title_id, "count": count,
+            "position": position, "positions": positions}
+                for word, (count, position, positions) in new.iteritems()
+                if word not in old]
+
+        for i in xrange(0, len(removed), 500):
+            self.db.execute(Posting.__table__.delete().where(and_(
+                Posting.page==title_id,
+                Posting.term.in_(removed[i:i+500]))))
+        if changed:
+            self.db.execute(Posting.__table__.update().\
+                    where(and_(Posting.term==bindparam("_term"),
+                        Posting.page==bindparam("_page"))).\
+                    values(count=bindparam("_count"),
+                        position=bindparam("_position"),
+                        positions=bindparam("_positions")), changed)
+        if added:
+            self.db.execute(Posting.__table__.insert(), added)
+
+        self.update_terms([row["term"] for row in added], removed)
+
+        length = sum(words.itervalues())
+        old_length = sum(row[1] for row in old.itervalues())
+        if length != old_length:
+            self.db.execute(Title.__table__.update().\
+                    where(Title.id==title_id).values(length=length))
+            self.add_stats(bool(words) - bool(old), length - old_length)
+
+    def term_ids(self, words, create=False):
+        """
+        Gives the ids of words in the term dictionary, leaving out unknown
+        words, or adding them (and their trigrams) if create is True.
+        """
+
+        ids = {}
+        missing = []
+        for word in words:
+            id = self._term_ids.get(word)
+            if id is None:
+                missing.append(word)
+            else:
+                ids[word] = id
+
+        ids.update(self._lookup_terms(missing))
+        missing = [word for word in missing if word not in ids]
+
+        if create and missing:
+            self.db.execute(Term.__table__.insert(),
+                    [{"term": word, "df": 0} for word in missing])
+            new = self._lookup_terms(missing)
+            self.update_trigrams(new)
+            ids.update(new)
+
+        return ids
+
+    def _lookup_terms(self, words):
+        """Looks up the ids of words, remembering them."""
+
+        ids = {}
+        for i in xrange(0, len(words), 500):
+            for id, word in self.db.query(Term.id, Term.term).\
+                    filter(Term.term.in_(words[i:i+500])):
+                ids[word] = id
+        self._term_ids.update(ids)
+        return ids
+
+    def update_terms(self, added, removed):
+        """Updates the number of pages each term appears on."""
+
+        changed = [{"_id": id, "_delta": 1} for id in added]
+        changed.extend({"_id": id, "_delta": -1} for id in removed)
+        if changed:
+            self.db.execute(Term.__table__.update().\
+                    where(Term.id==bindparam("_id")).\
+                    values(df=Term.df + bindparam("_delta")), changed)
+
+    def get_stats(self):
+        """Gives the number of indexed pages and their total length."""
+
+        stats = dict(self.db.query(schema.System.name, schema.System.value).\
+                filter(schema.System.name.in_(
+                    ("search_documents", "search_tokens"))))
+        return (int(stats.get("search_documents", 0)),
+                int(stats.get("search_tokens", 0)))
+
+    def add_stats(self, documents, tokens):
+        """Adjusts the number of indexed pages and their total length."""
+
+        if not (documents or tokens):
             return
-        words = self.count_words(self.split_text(text))
-        title_words = self.count_words(self.split_text(title))
-        for word, count in title_words.iteritems():
-            words[word] = words.get(word, 0) + count
 
-        self.db.begin(subtransactions=True)
+        old = self.get_stats()
+        for name, value in zip(("search_documents", "search_tokens"),
+                (old[0] + documents, old[1] + tokens)):
+            sysinfo = self.db.query(schema.System).get(name)
+            if sysinfo is None:
+                self.db.add(schema.System(name, value))
+            else:
+                sysinfo.value = value
 
-        try:
-            for word, count in words.iteritems():
-                self.db.add(Word(word, title_id, count))
-            self.db.commit()
-        except:
-            self.db.rollback()
-            raise
+    def update_text(self, title_id, text):
+        """Stores the text of a page for search result snippets."""
+
+        old = self.db.query(PageText).get(title_id)
+        if not text:
+            if old is not None:
+                self.db.delete(old)
+        elif old is None:
+            self.db.add(PageText(title_id, text))
+        elif old.text != text:
+            old.text = text
+
+    def update_trigrams(self, terms):
+        """Indexes the trigrams of new terms (words and their ids)."""
+
+        rows = [{"gram": gram, "term": id}
+                for word, id in terms.iteritems()
+                for gram in self.trigrams(word)]
+        for i in xrange(0, len(rows), 500):
+            self.db.execute(Trigram.__table__.insert(), rows[i:i+500])
 
     def update_links(self, title, links_and_labels):
+        """Updates the links of a page if they changed. The caller commits."""
+
         title_id = self.title_id(title)
-        self.db.query(Link).filter(Link.src==title_id).delete()
+        rows = [{"src": title_id, "target": link, "label": label,
+            "number": number}
+            for number, (link, label) in enumerate(links_and_labels)]
 
-        self.db.begin(subtransactions=True)
+        old = [{"src": title_id, "target": target, "label": label,
+            "number": number}
+            for target, label, number in
+            self.db.query(Link.target, Link.label, Link.number).\
+                    filter(Link.src==title_id).\
+                    order_by(Link.number)]
+        if old == rows:
+            return
 
-        try:
-            for number, (link, label) in enumerate(links_and_labels):
-                self.db.add(Link(title_id, link, label, number))
-            self.db.commit()
-        except:
-            self.db.rollback()
-            raise
+        self.db.execute(Link.__table__.delete().where(Link.src==title_id))
+        if rows:
+            self.db.execute(Link.__table__.insert(), rows)
+        self.links.set_links(title, [row["target"] for row in rows])
+
+    def link_graph(self):
+        """Gives the link graph, loading it from the database if needed."""
+
+        if not self.links.loaded:
+            # Holding the lock, no other thread has uncommitted links.
+            with self._lock:
+                if not self.links.loaded:
+                    titles = (title for (title,) in
+                            self.db.query(Title.title))
+                    links = self.db.query(Title.title, Link.target).\
+                            filter(Link.src==Title.id).\
+                            order_by(Link.src, Link.number)
+                    self.links.load(titles, links)
+        return self.links
+
+    def rollback(self):
+        """
+        Rolls back the session, forgetting the links and terms changed
+        with it.
+        """
+
+        self.db.rollback()
+        self.links.clear()
+        self._term_ids.clear()
+
+    def _on_pages_changed(self, titles):
+        if titles is None:
+            self.titles.clear()
+            return
+
+        for title in titles:
+            if title in self.storage:
+                self.titles.add(title)
+            else:
+                self.titles.remove(title)
+
+    def title_index(self):
+        """Gives the title index, loading it from the storage if needed."""
+
+        if not self.titles.loaded:
+            self.titles.load(self.storage.all_pages())
+        return self.titles
+
+    def suggest(self, title, limit=5):
+        """
+        Gives the scores and titles of up to limit existing pages with
+        titles similar to title, best first.
+        """
+
+        return self.title_index().similar(title, limit)
+
+    def complete(self, prefix, limit=10):
+        """Gives up to limit page titles starting with prefix."""
+
+        return self.title_index().complete(prefix, limit)
 
     def orphaned_pages(self):
         """Gives all pages with no links to them."""
 
-        stmt = ~exists().where(Link.target==Title.title)
-        orphaned = self.db.query(Title.title).\
-                filter(stmt).\
-                order_by(Title.title)
-        for (title,) in orphaned:
+        for title in self.link_graph().orphaned():
             yield unicode(title)
 
     def wanted_pages(self):
         """Gives all pages that are linked to, but don't exist, together with
         the number of links."""
 
-        stmt = ~exists().where(Title.title==Link.target)
-        wanted = self.db.query(func.count(), Link.target).\
-                filter(stmt).\
-                group_by(Link.target).\
-                order_by(-func.count())
-        for refs, title, in wanted:
+        for refs, title in self.link_graph().wanted():
             title = unicode(title)
             if not external_link(title) and not title.startswith('+'):
                 yield refs, title
@@ -198,11 +933,7 @@ without would yet you your yours yourself yourselves""")).split())
     def page_backlinks(self, title):
         """Gives a list of pages linking to specified page."""
 
-        backlinks = self.db.query(func.distinct(Title.title)).\
-                join((Link, Link.src==Title.id)).\
-                filter(Link.target==title).\
-                order_by(Title.title)
-        for (backlink,) in backlinks:
+        for backlink in self.link_graph().backlinks(title):
             yield unicode(backlink)
 
     def page_links(self, title):
@@ -223,64 +954,257 @@ without would yet you your yours yourself yourselves""")).split())
         for link, label in links:
             yield unicode(link), unicode(label)
 
-    def find(self, words):
-        """Iterator of all pages containing the words, and their scores."""
+    def _match(self, word):
+        """
+        Gives a condition matching terms containing word. Words of at
+        least three letters are looked up in the trigram index first.
+        """
 
-        ranks = []
-        for word in words:
-            # Calculate popularity of each word.
-            rank = self.db.query(func.sum(Word.count)).filter(
-                    Word.word.like("%%%s%%" % word)).first()[0]
-            # If any rank is 0, there will be no results anyways
-            if not rank:
+        like = Term.term.like("%%%s%%" % word)
+        if len(word) < 3 or "%" in word or "_" in word:
+            return like
+
+        grams = self.trigrams(word)
+        candidates = self.db.query(Trigram.term).\
+                filter(Trigram.gram.in_(grams)).\
+                group_by(Trigram.term).\
+                having(func.count(Trigram.gram)==len(grams))
+        return and_(Term.id.in_(candidates.subquery()), like)
+
+    def _split_terms(self, terms):
+        """
+        Splits query terms into the words a page must contain (including
+        those of phrases) and the phrases.
+        """
+
+        words = [term for term in terms if isinstance(term, basestring)]
+        phrases = [term for term in terms if not isinstance(term, basestring)]
+        words.extend(word for phrase in phrases for i, word in phrase.terms)
+        return words, phrases
+
+    def _postings(self, phrases, pages=None):
+        """
+        Iterator of the pages with all words of the phrases, and the
+        occurrences of those words, in one pass over their postings
+        sorted by page.
+        """
+
+        words = set(word for phrase in phrases for i, word in phrase.terms)
+        ids = self.term_ids(words)
+        if len(ids) < len(words):
+            return
+        words = dict((id, word) for word, id in ids.iteritems())
+
+        postings = self.db.query(Posting.page, Posting.term,
+                Posting.positions).filter(Posting.term.in_(words))
+        if pages is not None:
+            postings = postings.filter(Posting.page.in_(pages))
+
+        for page, rows in groupby(postings.order_by(Posting.page),
+                itemgetter(0)):
+            occurrences = dict((words[term], decode_positions(positions))
+                    for page, term, positions in rows)
+            if len(occurrences) == len(words):
+                yield page, occurrences
+
+    def _phrase_pages(self, phrases):
+        """
+        Gives the set of pages containing all the phrases, to be checked
+        against ranked rows in Python rather than bound into a query (a
+        common phrase may be on more pages than SQLite takes variables).
+        """
+
+        return set(page for page, occurrences in self._postings(phrases)
+                if all(phrase.matches(occurrences) for phrase in phrases))
+
+    def count(self, words):
+        """Number of pages containing all the words."""
+
+        words, phrases = self._split_terms(words)
+        if not words:
+            return 0
+
+        matches = [self._match(word) for word in words]
+        counts = [func.sum(case([(match, 1)], else_=0)) for match in matches]
+        results = self.db.query(Posting.page).\
+                filter(Posting.term==Term.id).\
+                filter(or_(*matches)).\
+                group_by(Posting.page).\
+                having(and_(*[count > 0 for count in counts]))
+        if phrases:
+            pages = self._phrase_pages(phrases)
+            if not pages:
+                return 0
+            return sum(1 for (page,) in results if page in pages)
+        return results.count()
+
+    def find(self, words, limit=None, offset=0):
+        """
+        Iterator of all pages containing the words (and phrases, see
+        parse_query), and their scores, best first. Gives at most limit
+        pages if limit is not None, skipping the first offset pages.
+        """
+
+        words, phrases = self._split_terms(words)
+        if not words:
+            return
+
+        # Nothing indexed has any words
+        documents, tokens = self.get_stats()
+        if not tokens:
+            return
+
+        # Number of pages with each word, estimated by the most common of
+        # the terms containing it, read in one pass over the terms. (The
+        # idf needs log(), which SQLite may not have, so it's not part of
+        # the query below.)
+        matches = [self._match(word) for word in words]
+        frequencies = self.db.query(*[func.max(case([(match, Term.df)]))
+            for match in matches]).filter(or_(*matches)).first()
+        # If any word is on no page, there will be no results anyways
+        if frequencies is None or not all(frequencies):
+            return
+
+        counts = [func.sum(case([(match, Posting.count)], else_=0))
+                for match in matches]
+
+        # A page's score is its BM25 score for the words. If page misses
+        # any of the words, it is left out.
+        k1, b = self.k1, self.b
+        norm = k1 * (1 - b) + (k1 * b * documents / tokens) * Title.length
+        score = reduce(add, [count * (idf * (k1 + 1)) / (count + norm)
+            for count, idf in zip(counts, [log(1 + (documents - n + 0.5) /
+                (n + 0.5)) for n in frequencies])]).label("score")
+        results = self.db.query(Posting.page, Title.title, score).\
+                filter(Title.id==Posting.page).\
+                filter(Posting.term==Term.id).\
+                filter(or_(*matches)).\
+                group_by(Posting.page, Title.title, Title.length).\
+                having(and_(*[count > 0 for count in counts])).\
+                order_by(desc("score"), Posting.page)
+        if phrases:
+            pages = self._phrase_pages(phrases)
+            if not pages:
                 return
-            ranks.append((rank, word))
-        ranks.sort()
-        # Start with the least popular word. Get all pages that contain it.
-        first_rank, first = ranks[0]
-        rest = ranks[1:]
-        first_counts = self.db.query(Word.page, Title.title,
-                func.sum(Word.count)).\
-                        filter(Word.word.like("%%%s%%" % first)).\
-                        filter(Title.id==Word.page).\
-                        group_by(Word.page)
-        # Check for the rest of words
-        for title_id, title, first_count in first_counts:
-            # Score for the first word
-            score = float(first_count)/first_rank
-            for rank, word in rest:
-                count = self.db.query(func.sum(Word.count)).\
-                        filter(Word.page==title_id).\
-                        filter(Word.word.like("%%%%s%%" % word)).\
-                        first()
-                if not count:
-                    # If page misses any of the words, its score is 0
-                    score = 0
-                    break
-                score += float(count)/rank
-            if score > 0:
-                yield int(100*score), unicode(title)
+            results = islice((row for row in results if row[0] in pages),
+                    offset, None if limit is None else offset + limit)
+        else:
+            if limit is not None:
+                results = results.limit(limit)
+            if offset:
+                results = results.offset(offset)
+
+        for page, title, score in results:
+            yield int(100*score), unicode(title)
+
+    def _snippet_query(self, words):
+        """
+        Gives the (cached) expression highlighting words in snippets, and
+        the statement fetching the text around their first occurrence.
+        """
+
+        query = self._snippet_queries.get(words)
+        if query is None:
+            if len(self._snippet_queries) > 100:
+                self._snippet_queries.clear()
+
+            regexp = re.compile(u"|".join(re.escape(w) for w in words),
+                    re.U | re.I)
+
+            # Only the page's own words are looked at, by the page index.
+            # The match may be anywhere inside the indexed word, so up to
+            # the length of a word more than the snippet is fetched.
+            statement = "SELECT postings.position, " \
+                    "substr(texts.text, CASE WHEN postings.position > :width " \
+                    "THEN postings.position - :width + 1 ELSE 1 END, " \
+                    ":width * 2 + :length) " \
+                    "FROM titles " \
+                    "JOIN postings ON postings.page = titles.id " \
+                    "JOIN terms ON terms.id = postings.term " \
+                    "JOIN texts ON texts.page = titles.id " \
+                    "WHERE titles.title = :title " \
+                    "AND postings.position IS NOT NULL AND (%s) " \
+                    "ORDER BY postings.position LIMIT 1" % " OR ".join(
+                            "terms.term LIKE :word%d" % i
+                            for i in xrange(len(words)))
+
+            query = self._snippet_queries[words] = regexp, statement
+        return query
+
+    def snippet(self, title, words):
+        """
+        Extract a snippet of text for search results, around the first
+        indexed occurrence of the words (or first phrase), from the text
+        stored in the index.
+        """
+
+        terms = words
+        words = self.query_words(terms)
+        width = self.snippet_width
+        regexp, statement = self._snippet_query(words)
+
+        params = {"title": title, "width": width,
+                "length": Term.term.type.length}
+
+        phrases = self._split_terms(terms)[1]
+        if phrases:
+            title_id = self.db.query(Title.id).\
+                    filter(Title.title==title).scalar()
+            position = None
+            for page, occurrences in self._postings(phrases, [title_id]):
+                matches = [phrase.matches(occurrences) for phrase in phrases]
+                if all(matches):
+                    position = min(match[0][2] for match in matches)
+            if position is None:
+                return u""
+            params["start"] = max(position - width, 0)
+            text = self.db.execute("SELECT "
+                    "substr(text, :start + 1, :width * 2 + :length) "
+                    "FROM texts WHERE page = :page",
+                    dict(params, page=title_id)).scalar()
+        else:
+            for i, word in enumerate(words):
+                params["word%d" % i] = u"%%%s%%" % word
+            row = self.db.execute(statement, params).first()
+            if row is None:
+                return u""
+            position, text = row
+
+        if not text:
+            return u""
+        start = max(position - width, 0)
+
+        match = regexp.search(text, position - start)
+        if match is None:
+            return u""
+        position = start + match.start()
+        min_pos = max(position - width, 0) - start
+        max_pos = position + width - start
+        # Marked before escaping, so words never match inside entities.
+        snippet = regexp.sub(u"\x01\\g<0>\x02", text[min_pos:max_pos])
+        return unicode(escape(snippet)).\
+                replace(u"\x01", u"<span class=\"highlight\">").\
+                replace(u"\x02", u"</span>")
 
     def reindex_page(self, page, title, text=None):
         """Updates the content of the database, needs locks around."""
 
         if text is None:
-            _get_text = getattr(page, '_get_text', lambda: u'')
             try:
-                text = _get_text()
+                text = self.storage.page_text(title)
             except NotFoundErr:
-                text = None
-                title_id = self.title_id(title)
-                if not list(self.page_backlinks(title)):
-                    self.db.query(Title).filter(Title.id==title_id).delete()
-
-        if text is not None:
-            links = extract_links(text)
-        else:
-            links = []
+                # Unindex the page before its title can be dropped.
+                self.update_links(title, [])
+                self.update_words(title, u'')
+                if not self.db.query(exists().where(
+                        Link.target==title)).scalar():
+                    self.db.query(Title).filter(
+                            Title.title==title).delete()
+                    self.links.remove_title(title)
+                return
 
-        self.update_links(title, links)
-        self.update_words(title, text or u'')
+        self.update_links(title, extract_links(text))
+        self.update_words(title, text)
 
     def update_page(self, page, title, data=None, text=None):
         """Updates the index with new page content, for a single page."""
@@ -288,16 +1212,21 @@ without would yet you your yours yourself yourselves""")).split())
         if text is None and data is not None:
             text = unicode(data, self.storage.charset, 'replace')
 
-        self.set_last_revision(self.storage.repo_revision())
-        self.reindex_page(page, title, text)
-        self.db.commit()
+        with self._lock:
+            try:
+                self.reindex_page(page, title, text)
+                self.db.commit()
+            except:
+                self.rollback()
+                raise
 
-    def reindex(self, environ, pages):
-        """Updates specified pages in bulk."""
+    def reindex(self, pages, batch=100):
+        """Updates specified pages in bulk, committing every batch pages."""
 
-        for title in pages:
-            page = environ.get_page(title)
-            self.reindex_page(page, title)
+        for i, title in enumerate(pages):
+            self.reindex_page(None, title)
+            if (i + 1) % batch == 0:
+                self.db.commit()
 
     def set_last_revision(self, rev):
         """Store the last indexed repository revision."""
@@ -312,23 +1241,213 @@ without would yet you your yours yourself yourselves""")).split())
         else:
             sysinfo.value = int(rev + 1)
 
+    def reset(self):
+        """Empties the index, so that it will be rebuilt from scratch."""
+
+        with self._lock:
+            self.upgrade()
+            self.db.query(Posting).delete()
+            self.db.query(Link).delete()
+            self.db.query(Trigram).delete()
+            self.db.query(Term).delete()
+            self._term_ids.clear()
+            self.db.query(PageText).delete()
+            self.db.query(Title).delete()
+            self.links.clear()
+            self.set_last_revision(-1)
+            self.db.query(schema.System).filter(schema.System.name.in_(
+                ("search_documents", "search_tokens"))).delete(
+                        synchronize_session=False)
+
+            sysinfo = self.db.query(schema.System).get("search_version")
+            if sysinfo is None:
+                self.db.add(schema.System("search_version", self.version))
+            else:
+                sysinfo.value = self.version
+            self.db.commit()
+
+    def upgrade(self):
+        """
+        Recreates index tables missing columns of their definition, and
+        drops the words table replaced by terms and postings.
+        """
+
+        bind = self.db.get_bind()
+        tables = inspect(bind).get_table_names()
+        if "words" in tables:
+            self.db.commit()
+            Table("words", MetaData()).drop(bind)
+
+        for table in (Title.__table__, Term.__table__, Posting.__table__,
+                Trigram.__table__, PageText.__table__):
+            if table.name not in tables:
+                self.db.commit()
+                table.create(bind)
+                continue
+            columns = set(column["name"] for column in
+                    inspect(bind).get_columns(table.name))
+            if not columns.issuperset(table.columns.keys()):
+                self.db.commit()
+                table.drop(bind)
+                table.create(bind)
+
+    def get_version(self):
+        """Retrieve the version of the index."""
+
+        return self.db.query(schema.System.value).filter(
+                schema.System.name=="search_version").scalar()
+
     def get_last_revision(self):
         """Retrieve the last indexed repository revision."""
 
-        sysinfo = self.db.query(schema.System).get("search_revision")
-        if sysinfo is None:
+        value = self.db.query(schema.System.value).filter(
+                schema.System.name=="search_revision").scalar()
+        if value is None:
             return -1
         else:
-            return int(sysinfo.value) - 1
+            return int(value) - 1
+
+    def lag(self):
+        """Number of repository revisions the index is behind."""
+
+        return self.storage.repo_revision() - self.get_last_revision()
 
-    def update(self, environ):
+    def update(self):
         """Reindex al pages that changed since last indexing."""
 
-        last_rev = self.get_last_revision()
-        if last_rev == -1:
-            changed = self.storage.all_pages()
-        else:
-            changed = self.storage.changed_since(last_rev)
-        self.reindex(environ, changed)
-        rev = self.storage.repo_revision()
-        self.set_last_revision(rev)
+        with self._lock:
+            if self.get_version() != str(self.version):
+                self.reset()
+
+            rev = self.storage.repo_revision()
+            last_rev = self.get_last_revision()
+            if last_rev == rev:
+                return
+            if last_rev == -1:
+                changed = self.storage.all_pages()
+            else:
+                changed = self.storage.changed_since(last_rev)
+            self.reindex(changed)
+            self.set_last_revision(rev)
+            self.db.commit()
+
+
+class FTSSearch(WikiSearch):
+    """
+    Keeps the text of pages in an SQLite FTS5 full text index instead of
+    the words table, ranking with bm25() and highlighting with snippet().
+    Links are indexed the same way as by WikiSearch.
+
+    Words are matched as prefixes of the words of a page, not anywhere
+    inside them.
+    """
+
+    version = "fts5-1"
+
+    def __init__(self, db, lang, storage):
+        super(FTSSearch, self).__init__(db, lang, storage)
+
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts "
+                "USING fts5(title, text)")
+        self.db.commit()
+
+    def _query(self, words):
+        """
+        Build an FTS5 query matching pages with all the words, phrases
+        and NEAR groups (see parse_query).
+        """
+
+        def quote(text):
+            return u'"%s"' % text.replace(u'"', u'""')
+
+        terms = []
+        for term in words:
+            if isinstance(term, Near):
+                terms.append(u"NEAR(%s, %d)" % (u" ".join(quote(phrase.text)
+                    for phrase in term.phrases), term.distance))
+            elif isinstance(term, Phrase):
+                terms.append(quote(term.text))
+            else:
+                terms.append(u"%s*" % quote(term))
+        return u" AND ".join(terms)
+
+    def update_words(self, title, text, words=None, occurrences=None):
+        title_id = self.title_id(title)
+        self.db.execute("DELETE FROM pages_fts WHERE rowid = :id",
+                {"id": title_id})
+        if not text:
+            return
+        self.db.execute("INSERT INTO pages_fts (rowid, title, text) "
+                "VALUES (:id, :title, :text)",
+                {"id": title_id, "title": title, "text": text})
+
+    def reindex_page(self, page, title, text=None):
+        # The title's row is deleted along with deleted pages, so drop
+        # the page's text while its id is still known.
+        self.db.execute("DELETE FROM pages_fts WHERE rowid IN "
+                "(SELECT id FROM titles WHERE title = :title)",
+                {"title": title})
+        super(FTSSearch, self).reindex_page(page, title, text)
+
+    def reset(self):
+        with self._lock:
+            self.db.execute("DELETE FROM pages_fts")
+            super(FTSSearch, self).reset()
+
+    def count(self, words):
+        """Number of pages containing all the words."""
+
+        if not words:
+            return 0
+
+        return self.db.execute("SELECT count(*) FROM pages_fts "
+                "WHERE pages_fts MATCH :query",
+                {"query": self._query(words)}).scalar()
+
+    def find(self, words, limit=None, offset=0):
+        """
+        Iterator of all pages containing the words, and their scores,
+        best first. Gives at most limit pages if limit is not None,
+        skipping the first offset pages.
+        """
+
+        if not words:
+            return
+
+        results = self.db.execute("SELECT titles.title, "
+                "bm25(pages_fts, 10.0, 1.0) AS rank "
+                "FROM pages_fts JOIN titles ON titles.id = pages_fts.rowid "
+                "WHERE pages_fts MATCH :query "
+                "ORDER BY rank LIMIT :limit OFFSET :offset",
+                {"query": self._query(words),
+                 "limit": -1 if limit is None else limit,
+                 "offset": offset})
+
+        # bm25() is negative, and tiny for words on most pages.
+        for title, rank in results:
+            yield -100 * rank, unicode(title)
+
+    def snippet(self, title, words):
+        """Extract a snippet of text for search results."""
+
+        snippet = self.db.execute("SELECT "
+                "snippet(pages_fts, 1, :start, :end, :ellipsis, 16) "
+                "FROM pages_fts WHERE pages_fts MATCH :query "
+                "AND rowid = (SELECT id FROM titles WHERE title = :title)",
+                {"start": u"\x01", "end": u"\x02", "ellipsis": u"\u2026",
+                 "query": self._query(words), "title": title}).scalar()
+
+        if snippet is None:
+            return u""
+
+        return unicode(escape(snippet)).\
+                replace(u"\x01", u"<span class=\"highlight\">").\
+                replace(u"\x02", u"</span>")
+
+
+def search_class(config, engine):
+    """Gives the search implementation selected by the configuration."""
+
+    if config.get("search") == "fts" and engine.name == "sqlite":
+        return FTSSearch
+    return WikiSearch
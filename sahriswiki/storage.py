@@ -11,6 +11,7 @@ import re
 import os
 import thread
 import tempfile
+from threading import RLock
 from urllib import quote, unquote
 
 import mercurial.hg
@@ -76,41 +77,141 @@ class WikiStorage(object):
         else:
             create = False
         self.repo_prefix = self.path[len(self.repo_path):].strip('/')
+        # Guards the state below, shared by request threads and the
+        # background Indexer.
+        self._lock = RLock()
         self._repos = {}
         self._workingctxs = {}
+        # Index of tracked files and directories (see _index)
+        self._files = None
+        self._dirs = None
+        # Metadata of files as of the tip (see _file_meta)
+        self._meta = {}
+        self._meta_tip = None
+        # Callbacks notified of repository changes (see subscribe)
+        self._listeners = []
         # Create the repository if needed.
         mercurial.hg.repository(self.ui, self.repo_path, create=create)
+        store = os.path.join(self.repo_path, ".hg", "store")
+        if not os.path.isdir(store):
+            store = os.path.join(self.repo_path, ".hg")
+        self._watched = (
+            os.path.join(self.repo_path, ".hg", "dirstate"),
+            os.path.join(store, "00changelog.i"),
+        )
+        self._signature = self._stat()
+        self._tip = self._changectx().node()
 
     def reopen(self):
         """Close and reopen the repo, to make sure we are up to date."""
 
         #self.repo = mercurial.hg.repository(self.ui, self.repo_path)
-        self._repos = {}
-        self._workingctxs = {}
+        with self._lock:
+            self._repos = {}
+            self._workingctxs = {}
+            self._files = None
+            self._dirs = None
+
+    def _stat(self):
+        """Stat signature of the changelog and dirstate."""
+
+        signature = []
+        for path in self._watched:
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((st.st_ino, st.st_size, st.st_mtime))
+        return tuple(signature)
+
+    def refresh(self):
+        """
+        Reopen the repo if it was changed from outside (e.g. a push) and
+        notify subscribers if the tip moved. Returns whether the repo was
+        reopened.
+        """
+
+        with self._lock:
+            signature = self._stat()
+            if signature == self._signature:
+                return False
+
+            self._signature = signature
+            self.reopen()
+
+            changectx = self._changectx()
+            if changectx.node() == self._tip:
+                return True
+
+            files = self._changed_files(self._tip, changectx)
+            self._tip = changectx.node()
+
+        # Subscribers are notified without holding the lock.
+        if files is None:
+            self._notify(None)
+        else:
+            self._notify([self._file_to_title(repo_file)
+                for repo_file in files
+                if repo_file.startswith(self.repo_prefix)])
+
+        return True
+
+    def subscribe(self, callback):
+        """
+        Call callback(titles) whenever the tip of the repository moves.
+        titles is a list of the (unicode) titles of changed pages, or None
+        if they are not known and anything might have changed.
+        """
+
+        self._listeners.append(callback)
+
+    def _notify(self, titles):
+        if titles is not None:
+            # Titles of changed files are byte strings.
+            titles = [title if isinstance(title, unicode)
+                    else unicode(title, self.charset, 'replace')
+                    for title in titles]
+        for callback in self._listeners:
+            callback(titles)
+
+    def _committed(self, title):
+        # Repos opened by other threads don't know the new changeset yet.
+        thread_id = thread.get_ident()
+        with self._lock:
+            self._repos = {thread_id: self.repo}
+            self._workingctxs = dict((key, value)
+                    for key, value in self._workingctxs.iteritems()
+                    if key == thread_id)
+            self._tip = self._changectx().node()
+            self._signature = self._stat()
+        self._notify([title])
 
     @property
     def repo(self):
         """Keep one open repository per thread."""
 
         thread_id = thread.get_ident()
-        try:
-            return self._repos[thread_id]
-        except KeyError:
-            repo = mercurial.hg.repository(self.ui, self.repo_path)
-            self._repos[thread_id] = repo
-            return repo
+        with self._lock:
+            try:
+                return self._repos[thread_id]
+            except KeyError:
+                repo = mercurial.hg.repository(self.ui, self.repo_path)
+                self._repos[thread_id] = repo
+                return repo
 
     @property
     def workingctx(self):
         """Keep one open working ctx per thread."""
 
         thread_id = thread.get_ident()
-        try:
-            return self._workingctxs[thread_id]
-        except KeyError:
-            workingctx = mercurial.context.workingctx(self.repo)
-            self._workingctxs[thread_id] = workingctx
-            return workingctx
+        with self._lock:
+            try:
+                return self._workingctxs[thread_id]
+            except KeyError:
+                workingctx = mercurial.context.workingctx(self.repo)
+                self._workingctxs[thread_id] = workingctx
+                return workingctx
 
     def _find_repo_path(self, path):
         """Go up the directory tree looking for a repository."""
@@ -159,10 +260,52 @@ class WikiStorage(object):
             name = name[1:]
         return unquote(name)
 
+    def _index(self):
+        """
+        Build the index of tracked files (and the directories containing
+        them) from the dirstate, if it isn't built yet. Gives both, as
+        another thread may drop them (see reopen) at any time.
+        """
+
+        with self._lock:
+            if self._files is None:
+                files, dirs = set(), {}
+                dirstate = self.repo.dirstate
+                for repo_file in dirstate:
+                    if dirstate[repo_file] in "nam":
+                        self._index_add(files, dirs, repo_file)
+                self._files, self._dirs = files, dirs
+            return self._files, self._dirs
+
+    def _index_add(self, files, dirs, repo_file):
+        if repo_file in files:
+            return
+        files.add(repo_file)
+        path = repo_file
+        while path:
+            path = os.path.dirname(path)
+            dirs[path] = dirs.get(path, 0) + 1
+
+    def _index_remove(self, files, dirs, repo_file):
+        if repo_file not in files:
+            return
+        files.remove(repo_file)
+        path = repo_file
+        while path:
+            path = os.path.dirname(path)
+            dirs[path] -= 1
+            if not dirs[path]:
+                del dirs[path]
+
+    def _isfile(self, repo_file):
+        return repo_file in self._index()[0]
+
+    def _isdir(self, repo_file):
+        return repo_file in self._index()[1]
+
     def __contains__(self, title):
         if title:
-            file_path = self._file_path(title)
-            return os.path.isfile(file_path) and not os.path.islink(file_path)
+            return self._isfile(self._title_to_file(title))
 
     def __iter__(self):
         return self.all_pages()
@@ -217,6 +360,10 @@ class WikiStorage(object):
             user = '<wiki>'
             text = msg.encode('utf-8')
         self._commit([repo_file], text, user)
+        with self._lock:
+            if self._files is not None:
+                self._index_add(self._files, self._dirs, repo_file)
+        self._committed(title)
 
 
     def _commit(self, files, text, user):
@@ -269,8 +416,16 @@ class WikiStorage(object):
             os.unlink(file_path)
         except OSError:
             pass
-        self.workingctx.remove([repo_file])
+        try:
+            self.workingctx.remove([repo_file])
+        except AttributeError:
+            # Later Mercurial versions only have forget
+            self.workingctx.forget([repo_file])
         self._commit([repo_file], text, user)
+        with self._lock:
+            if self._files is not None:
+                self._index_remove(self._files, self._dirs, repo_file)
+        self._committed(title)
 
     def open_page(self, title):
         """Open the page and return a file-like object with its contents."""
@@ -295,19 +450,25 @@ class WikiStorage(object):
     def page_meta(self, title):
         """Get page's revision, date, last editor and his edit comment."""
 
-        filectx_tip = self._find_filectx(title)
-        if filectx_tip is None:
+        meta = self._file_meta(self._title_to_file(title))
+        if meta is None:
             raise NotFoundErr()
             #return -1, None, u'', u''
-        rev = filectx_tip.filerev()
-        node = filectx_tip.node()
-        filectx = filectx_tip.filectx(rev)
-        date = filectx.date()[0]
-        author = unicode(filectx.user(), "utf-8",
-                         'replace').split('<')[0].strip()
-        comment = unicode(filectx.description(), "utf-8", 'replace')
+        rev, filenode, node, date, author, comment = meta
         return rev, node, date, author, comment
 
+    def page_node(self, title):
+        """Get the file node of the page's revision in the tip."""
+
+        repo_file = self._title_to_file(title)
+        # Deleted pages still have a latest revision.
+        if not self._isfile(repo_file):
+            raise NotFoundErr()
+        meta = self._file_meta(repo_file)
+        if meta is None:
+            raise NotFoundErr()
+        return meta[1]
+
     def repo_revision(self):
         """Give the latest revision of the repository."""
 
@@ -328,33 +489,108 @@ class WikiStorage(object):
             # Mercurial 1.3 (and possibly earlier) needs an argument
             return self.repo.changectx('tip')
 
-    def _find_filectx(self, title):
-        """Find the last revision in which the file existed."""
+    def _update_meta(self, changectx):
+        """
+        Forget the metadata of files changed since the last seen tip.
 
-        repo_file = self._title_to_file(title)
-        stack = [self._changectx()]
+        Everything is forgotten unless the new tip is a linear descendant
+        of the last seen tip.
+        """
+
+        tip = changectx.node()
+        with self._lock:
+            if tip == self._meta_tip:
+                return
+
+            meta = self._meta
+            files = self._changed_files(self._meta_tip, changectx)
+            if files is None:
+                meta = {}
+            else:
+                for repo_file in files:
+                    meta.pop(repo_file, None)
+
+            self._meta, self._meta_tip = meta, tip
+
+    def _changed_files(self, node, changectx):
+        """
+        Give the set of files changed between the changeset node and
+        changectx, or None unless changectx is a linear descendant of it.
+        """
 
-        while stack:
-            changectx = stack.pop()
-            if repo_file in changectx:
-               return changectx[repo_file]
-            if changectx.rev() == 0:
+        if node is None:
+            return None
+        try:
+            last = self.repo.changelog.rev(node)
+        except mercurial.revlog.LookupError:
+            return None
+        if last > changectx.rev():
+            return None
+
+        files = set()
+        for rev in xrange(last + 1, changectx.rev() + 1):
+            change = self.repo.changectx(rev)
+            parents = change.parents()
+            if len(parents) != 1 or parents[0].rev() != rev - 1:
                 return None
-            for parent in changectx.parents():
-                if parent and parent not in stack:
-                    stack.append(parent)
-        return None
+            files.update(change.files())
+        return files
+
+    def _file_meta(self, repo_file):
+        """
+        Get the revision, file node, node, date, author and comment of
+        the last revision of the file, or None if it was never committed.
+
+        The node is that of the tip if the file exists in it, like the
+        changeset a page's edit form is based on.
+        """
+
+        changectx = self._changectx()
+        self._update_meta(changectx)
+
+        with self._lock:
+            meta = self._meta.get(repo_file)
+        if meta is not None:
+            rev, filenode, node, date, author, comment = meta
+            return rev, filenode, node or changectx.node(), date, author, comment
+
+        filelog = self.repo.file(repo_file)
+        try:
+            filenode = changectx.filenode(repo_file)
+            tip = True
+        except mercurial.revlog.LookupError:
+            if not len(filelog):
+                return None
+            filenode = filelog.node(len(filelog) - 1)
+            tip = False
+
+        rev = filelog.rev(filenode)
+        change = self.repo.changectx(filelog.linkrev(rev))
+        node = None if tip else change.node()
+        date = change.date()[0]
+        author = unicode(change.user(), "utf-8",
+                         'replace').split('<')[0].strip()
+        comment = unicode(change.description(), "utf-8", 'replace')
+
+        # Unless another thread has seen a newer tip meanwhile
+        with self._lock:
+            if self._meta_tip == changectx.node():
+                self._meta[repo_file] = (rev, filenode, node, date, author,
+                        comment)
+
+        return rev, filenode, node or changectx.node(), date, author, comment
 
     def page_history(self, title):
         """Iterate over the page's history."""
 
-        filectx_tip = self._find_filectx(title)
-        if filectx_tip is None:
+        repo_file = self._title_to_file(title)
+        meta = self._file_meta(repo_file)
+        if meta is None:
             return
-        maxrev = filectx_tip.filerev()
+        maxrev = meta[0]
         minrev = 0
         for rev in range(maxrev, minrev-1, -1):
-            filectx = filectx_tip.filectx(rev)
+            filectx = self.repo.filectx(repo_file, fileid=rev)
             date = filectx.date()[0]
             author = unicode(filectx.user(), "utf-8",
                              'replace').split('<')[0].strip()
@@ -364,12 +600,12 @@ class WikiStorage(object):
     def page_revision(self, title, rev):
         """Get binary content of the specified revision of the page."""
 
-        filectx_tip = self._find_filectx(title)
-        if filectx_tip is None:
+        repo_file = self._title_to_file(title)
+        if self._file_meta(repo_file) is None:
             raise NotFoundErr()
         try:
-            data = filectx_tip.filectx(rev).data()
-        except IndexError:
+            data = self.repo.filectx(repo_file, fileid=rev).data()
+        except (IndexError, mercurial.revlog.LookupError):
             raise NotFoundErr()
         return data
 
@@ -527,36 +763,15 @@ class WikiSubdirectoryIndexesStorage(WikiSubdirectoryStorage):
     A version of WikiSubdirectoryStorage that defaults to a set of indexes.
     """
 
-    def _file_path(self, title):
-        root = super(WikiSubdirectoryIndexesStorage, self)._file_path(title)
-
-        if os.path.isfile(root) and not os.path.islink(root):
-            return root
-        elif os.path.isdir(root):
-            for index in self.config.get("indexes"):
-                path = os.path.join(root, index)
-                if os.path.isfile(path) and not os.path.islink(path):
-                    return path
-            return os.path.join(root, self.config.get("indexes")[0])
-        return root
-
     def _title_to_file(self, title):
         root = super(WikiSubdirectoryIndexesStorage, self)._title_to_file(title)
 
-        def exists(path):
-            file_path = os.path.join(self.repo_path, path)
-            return os.path.isfile(file_path) and not os.path.islink(file_path)
-
-        def isdir(path):
-            file_path = os.path.join(self.repo_path, path)
-            return os.path.isdir(file_path) and not os.path.islink(file_path)
-
-        if not exists(root):
+        if not self._isfile(root):
             for index in self.config.get("indexes"):
                 path = os.path.join(root, index)
-                if exists(path):
+                if self._isfile(path):
                     return path
-            if isdir(root):
+            if self._isdir(root):
                 return os.path.join(root, self.config.get("index"))
 
         return root
@@ -608,10 +823,11 @@ class WikiSubdirectoryIndexesStorage(WikiSubdirectoryStorage):
     def page_parent(self, title):
         filename = self._file_path(title)
         parent = os.path.dirname(filename)
+        repo_parent = os.path.dirname(self._title_to_file(title))
 
-        if os.path.isdir(parent) and not os.path.islink(parent):
+        if self._isdir(repo_parent):
             type = "dir"
-        elif os.path.isfile(parent) and not os.path.islink(parent):
+        elif self._isfile(repo_parent):
             type = "file"
         else:
             parent = None
@@ -0,0 +1,64 @@
+# Module:   throttle
+
+"""Request Throttling
+
+Per client token buckets limiting the rate of costly responses.
+"""
+
+from time import time
+from threading import Lock
+from collections import OrderedDict
+
+
+class TokenBuckets(object):
+    """A token bucket per client.
+
+    Each bucket holds up to ``burst`` tokens and refills at ``rate``
+    tokens per second. Only the ``clients`` most recently seen clients
+    are tracked; forgotten clients start again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, clients=10000):
+        super(TokenBuckets, self).__init__()
+
+        self.rate = rate
+        self.burst = burst
+        self.clients = clients
+
+        self.denied = 0
+
+        self._lock = Lock()
+        self._buckets = OrderedDict()  # client -> (tokens, time)
+
+    def consume(self, client):
+        """Take a token from client's bucket. Returns False if empty."""
+
+        if not self.rate:
+            return True
+
+        now = time()
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                allowed = True
+            else:
+                allowed = False
+                self.denied += 1
+
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.clients:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def wait(self, client):
+        """Seconds until client's bucket holds a token again."""
+
+        with self._lock:
+            tokens, last = self._buckets.get(client, (self.burst, time()))
+
+        tokens += (time() - last) * self.rate
+        return max(0.0, (1 - tokens) / self.rate) if self.rate else 0.0
@@ -99,5 +99,5 @@ class SignalHandler(BaseComponent):
     @handler("signal", channel="*")
     def _on_signal(self, sig, stack):
         if os.name == "posix" and sig == signal.SIGHUP:
-            self.storage.reopen()
+            self.environ.storage.reopen()
             self.environ.config.reload_config()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import sys
+
+import pytest
+
+from genshi.builder import tag
+
+from sahriswiki.config import Config
+from sahriswiki.env import Environment
+from sahriswiki.throttle import TokenBuckets
+
+
+class Remote(object):
+
+    ip = "127.0.0.1"
+
+
+class Request(object):
+
+    base = "http://localhost:8000"
+    login = None
+
+    def __init__(self):
+        self.headers = {}
+        self.kwargs = {}
+        self.remote = Remote()
+        self.session = {}
+
+    def uri(self, path):
+        return self.base + path
+
+
+class Response(object):
+
+    def __init__(self):
+        self.status = 200
+        self.headers = {}
+
+
+@pytest.fixture
+def env(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["sahriswiki",
+        "--repo", str(tmpdir.join("wiki")), "--database", "sqlite://"])
+    env = Environment(Config())
+    env.dbm.create_tables()
+    env.search.reset()
+    env.request = Request()
+    env.response = Response()
+    return env
+
+
+def view(env, name):
+    """Render page name like a page view, telling whether it was rendered."""
+
+    rendered = []
+    data = {}
+
+    def render():
+        rendered.append(name)
+        return env.parse(name, env.storage.page_text(name), data)
+
+    node = env.storage.page_node(name)
+    stream = env.cached(name, node, render, data)
+    return stream.render("xhtml", encoding=None).strip(), bool(rendered)
+
+
+def test_cached(env):
+    env.storage.save_text(u"FrontPage", u"Hello **World**")
+
+    assert view(env, u"FrontPage") == (u"<p>Hello <strong>World</strong></p>",
+            True)
+    assert view(env, u"FrontPage") == (u"<p>Hello <strong>World</strong></p>",
+            False)
+
+    # Unrelated changes keep the cached render.
+    env.storage.save_text(u"Other", u"text")
+    assert view(env, u"FrontPage")[1] is False
+
+
+def test_invalidated_by_edit(env):
+    env.storage.save_text(u"FrontPage", u"one")
+    assert view(env, u"FrontPage") == (u"<p>one</p>", True)
+
+    env.storage.save_text(u"FrontPage", u"two")
+    assert view(env, u"FrontPage") == (u"<p>two</p>", True)
+
+
+def test_invalidated_by_edit_of_include(env):
+    env.storage.save_text(u"Included", u"one")
+    env.storage.save_text(u"FrontPage", u'<<include "Included">>')
+    assert u"one" in view(env, u"FrontPage")[0]
+
+    env.storage.save_text(u"Included", u"two")
+    html, rendered = view(env, u"FrontPage")
+    assert rendered and u"two" in html
+
+
+def test_invalidated_by_delete_of_include(env):
+    env.storage.save_text(u"Included", u"one")
+    env.storage.save_text(u"FrontPage", u'<<include "Included">>')
+    assert u"one" in view(env, u"FrontPage")[0]
+
+    env.storage.delete_page(u"Included")
+    html, rendered = view(env, u"FrontPage")
+    assert rendered and u"Page Included Not Found" in html
+
+
+def test_invalidated_by_created_link_target(env):
+    env.storage.save_text(u"FrontPage", u"[[Missing]]")
+    assert u'class="wiki new"' in view(env, u"FrontPage")[0]
+
+    env.storage.save_text(u"Missing", u"text")
+    html, rendered = view(env, u"FrontPage")
+    assert rendered and u'class="wiki"' in html
+
+
+def test_parse_fills_volatile_macros(env, monkeypatch):
+    calls = []
+
+    def counter(macro, environ, data, *args, **kwargs):
+        calls.append(macro.name)
+        return u"call %d" % len(calls)
+
+    counter.volatile = True
+    monkeypatch.setitem(env.macros, "counter", counter)
+
+    compiles = []
+    compile = env.parser.compile
+
+    def counted(*args, **kwargs):
+        compiles.append(args)
+        return compile(*args, **kwargs)
+
+    monkeypatch.setattr(env.parser, "compile", counted)
+
+    text = u"**Count** <<counter>>"
+    render = lambda: env.parse(u"FrontPage", text, {}).render(
+            "xhtml", encoding=None).strip()
+
+    assert render() == u"<p><strong>Count</strong> call 1</p>"
+    # The tree is reused, only the macro is run again.
+    assert render() == u"<p><strong>Count</strong> call 2</p>"
+    assert len(compiles) == 1
+
+    # Volatile pages are not kept in the render cache.
+    env.storage.save_text(u"FrontPage", text)
+    assert view(env, u"FrontPage")[1] is True
+    assert view(env, u"FrontPage")[1] is True
+
+
+def test_template_include_of_deleted_page(env):
+    env.storage.save_text(u"SiteMenu", u"* [[FrontPage]]")
+    assert u"FrontPage" in env.template_include(u"SiteMenu")
+    # Cached
+    assert u"FrontPage" in env.template_include(u"SiteMenu")
+
+    env.storage.delete_page(u"SiteMenu")
+    html = env.template_include(u"SiteMenu").generate().render("xhtml",
+            encoding=None)
+    assert u"Page SiteMenu Not Found" in html
+
+
+def test_trusted_proxies_option(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["sahriswiki",
+        "--trusted-proxies", "10.0.0.1", "--trusted-proxies", "10.0.0.2",
+        "reindex"])
+    config = Config()
+    assert config.get("trusted-proxies") == ["10.0.0.1", "10.0.0.2"]
+    assert config.get("command") == "reindex"
+
+
+def test_notfound_cached(env, monkeypatch):
+    renders = []
+    render = env.render
+
+    def counted(template, **data):
+        renders.append(data["title"])
+        return render(template, **data)
+
+    monkeypatch.setattr(env, "render", counted)
+
+    body = env.notfound(u"Missing")
+    assert env.response.status == 404
+    assert env.notfound(u"Missing") == body
+    assert renders == [u"Missing"]
+
+    # Creating the page, or changing the site menu, drops the render.
+    env.storage.save_text(u"Missing", u"text")
+    env.notfound(u"Missing")
+    assert renders == [u"Missing"] * 2
+
+    env.storage.save_text(u"SiteMenu", u"* [[FrontPage]]")
+    env.notfound(u"Missing")
+    assert renders == [u"Missing"] * 3
+
+
+def test_notfound_throttled(env):
+    env.notfound_throttle = TokenBuckets(0.5, 2)
+
+    env.notfound(u"One")
+    env.notfound(u"Two")
+    assert env.notfound(u"Three") == "Too many requests for missing pages"
+    assert env.response.status == 429
+    assert env.response.headers["Retry-After"] == "2"
+
+    # Other clients have buckets of their own.
+    env.request.remote.ip = "127.0.0.2"
+    env.notfound(u"Three")
+    assert env.response.status == 404
+
+
+def test_notfound_throttled_behind_proxy(env):
+    env.notfound_throttle = TokenBuckets(0.5, 1)
+    env.config["trusted-proxies"] = ["127.0.0.1"]
+
+    env.request.headers["X-Forwarded-For"] = "10.0.0.1"
+    env.notfound(u"One")
+    assert env.notfound(u"Two") == "Too many requests for missing pages"
+
+    env.request.headers["X-Forwarded-For"] = "10.0.0.1, 10.0.0.2"
+    env.notfound(u"Two")
+    assert env.response.status == 404
+
+
+def test_parse_reparses_changed_macro_text(env, monkeypatch):
+    values = [u"**one**", u"**one**", u"//two//", tag.em(u"three")]
+
+    def counter(macro, environ, data, *args, **kwargs):
+        return values.pop(0)
+
+    counter.volatile = True
+    monkeypatch.setitem(env.macros, "counter", counter)
+
+    render = lambda: env.parse(u"FrontPage", u"<<counter>> and [[Other]]",
+            {}).render("xhtml", encoding=None).strip()
+
+    first = render()
+    assert u"<strong>one</strong> and" in first
+    assert render() == first
+    # Changed wiki text returned by the macro is parsed again.
+    assert render() == first.replace(u"<strong>one</strong>", u"<em>two</em>")
+    assert render() == first.replace(u"<strong>one</strong>",
+            u"<em>three</em>")
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+from StringIO import StringIO
+
+from sahriswiki import schema
+from sahriswiki.reindex import reindex
+from sahriswiki.search import WikiSearch
+from sahriswiki.dbm import DatabaseManager
+from sahriswiki.storage import WikiSubdirectoryIndexesStorage
+
+
+def test_reindex_keeps_other_tables(tmpdir):
+    config = {"indexes": ["Index", "index.html", "index.rst"],
+            "index": "Index", "repo": str(tmpdir.join("wiki")),
+            "encoding": "utf-8", "language": "en", "jobs": 1,
+            "db": "sqlite:///%s" % tmpdir.join("sahriswiki.db")}
+
+    storage = WikiSubdirectoryIndexesStorage(config, config["repo"])
+    storage.save_text(u"FrontPage", u"a red apple [[Other]]")
+
+    dbm = DatabaseManager(config["db"])
+    dbm.create_tables()
+    search = WikiSearch(dbm.session, "en", storage)
+    search.reset()
+    dbm.session.add(schema.User("alice", "secret"))
+    dbm.session.commit()
+
+    reindex(config, StringIO())
+    dbm.session.remove()
+
+    assert dbm.session.query(schema.User).get("alice") is not None
+    assert [title for score, title in search.find(
+        search.parse_query(u"apple"))] == [u"FrontPage"]
+    assert search.get_last_revision() == storage.repo_revision()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import pytest
+
+from sahriswiki.search import WikiSearch, FTSSearch, TitleIndex, LinkGraph
+from sahriswiki.dbm import DatabaseManager
+from sahriswiki.storage import WikiSubdirectoryIndexesStorage
+
+
+@pytest.fixture
+def db():
+    dbm = DatabaseManager("sqlite://")
+    dbm.create_tables()
+    return dbm.session
+
+
+@pytest.fixture
+def search(db):
+    search = WikiSearch(db, "en", None)
+    search.reset()
+    return search
+
+
+@pytest.fixture
+def storage(tmpdir):
+    config = {"indexes": ["Index", "index.html", "index.rst"],
+            "index": "Index"}
+    return WikiSubdirectoryIndexesStorage(config, str(tmpdir.join("wiki")))
+
+
+def test_phrase_on_many_pages(search):
+    # More pages than SQLite (before 3.32) takes variables in a statement
+    for i in xrange(1200):
+        search.update_words(u"Page%d" % i, u"a red apple pie")
+    search.update_words(u"Other", u"a red pie and an apple")
+    search.db.commit()
+
+    terms = search.parse_query(u'"red apple" pie')
+    assert search.count(terms) == 1200
+
+    results = list(search.find(terms, limit=10, offset=1195))
+    assert len(results) == 5
+    assert u"Other" not in [title for score, title in results]
+
+
+def test_non_ascii_title_changed_outside(db, storage):
+    search = WikiSearch(db, "en", storage)
+    search.title_index()
+
+    # Like a push, the storage learns about these changes on refresh().
+    other = WikiSubdirectoryIndexesStorage(storage.config, storage.path)
+
+    other.save_text(u"Cr\xe8me", u"text")
+    storage.refresh()
+    assert search.suggest(u"Cr\xe8mes") == [(72, u"Cr\xe8me")]
+
+    other.delete_page(u"Cr\xe8me")
+    storage.refresh()
+    assert search.suggest(u"Cr\xe8mes") == []
+
+
+def test_complete_non_ascii_prefix(db, storage):
+    storage.save_text(u"Cr\xe8me Br\xfbl\xe9e", u"text")
+    storage.save_text(u"Crumble", u"text")
+    search = WikiSearch(db, "en", storage)
+
+    assert search.complete(u"cr\xe8") == [u"Cr\xe8me Br\xfbl\xe9e"]
+    assert search.complete("cr\xc3\xa8") == [u"Cr\xe8me Br\xfbl\xe9e"]
+    assert search.complete(u"CR") == [u"Crumble", u"Cr\xe8me Br\xfbl\xe9e"]
+
+
+def test_snippet_escapes_text(search):
+    search.update_words(u"Page", u"<script>alert(1)</script> & apple pie")
+    search.db.commit()
+
+    snippet = search.snippet(u"Page", search.parse_query(u"apple"))
+    assert u"<script>" not in snippet
+    assert snippet == (u"&lt;script&gt;alert(1)&lt;/script&gt; &amp; "
+            u"<span class=\"highlight\">apple</span> pie")
+
+
+def test_update_rebuilds_words_table(db, storage):
+    # The words table of unversioned indexes is not migrated.
+    db.execute("CREATE TABLE words (id INTEGER PRIMARY KEY, "
+            "word VARCHAR(80), page VARCHAR(80), count INTEGER)")
+    db.execute("INSERT INTO words (word, page, count) "
+            "VALUES ('stale', 'FrontPage', 1)")
+    db.commit()
+
+    storage.save_text(u"FrontPage", u"a red apple")
+    search = WikiSearch(db, "en", storage)
+    search.update()
+
+    assert "words" not in db.get_bind().table_names()
+    assert search.get_version() == str(search.version)
+    assert list(search.find(search.parse_query(u"apple"))) != []
+    assert list(search.find(search.parse_query(u"stale"))) == []
+
+
+def test_find_ranks_by_bm25(search):
+    search.update_words(u"Once", u"apple pie with a crust")
+    search.update_words(u"Often", u"apple apple apple pie")
+    search.update_words(u"Pie", u"cherry pie")
+    search.db.commit()
+
+    results = list(search.find(search.parse_query(u"apple pie")))
+    assert [title for score, title in results] == [u"Often", u"Once"]
+    assert results[0][0] > results[1][0] > 0
+
+    # Words are matched inside indexed words.
+    assert [title for score, title in search.find(
+        search.parse_query(u"herr"))] == [u"Pie"]
+    assert list(search.find(search.parse_query(u"banana pie"))) == []
+
+
+def test_find_in_empty_index(search):
+    assert list(search.find(search.parse_query(u"apple"))) == []
+
+
+def test_fts_scores_common_words(db):
+    search = FTSSearch(db, "en", None)
+    search.reset()
+    search.update_words(u"Once", u"apple pie")
+    search.update_words(u"Often", u"apple apple apple pie")
+    search.update_words(u"Other", u"apple crumble")
+    search.db.commit()
+
+    results = list(search.find(search.parse_query(u"apple")))
+    assert [title for score, title in results][0] == u"Often"
+    assert all(score > 0 for score, title in results)
+
+
+def test_find_pages(search):
+    for i in xrange(1, 6):
+        search.update_words(u"Page%d" % i, u" ".join([u"apple"] * i +
+            [u"filler"] * 10))
+    search.update_words(u"Other", u"pie")
+    search.db.commit()
+
+    terms = search.parse_query(u"apple")
+    results = [title for score, title in search.find(terms)]
+    assert results == [u"Page5", u"Page4", u"Page3", u"Page2", u"Page1"]
+    assert search.count(terms) == 5
+
+    assert [title for score, title in search.find(terms, limit=2,
+        offset=1)] == results[1:3]
+
+
+def test_find_inside_words(search):
+    search.update_words(u"Fruit", u"pineapple juice")
+    search.update_words(u"Other", u"pie")
+    search.db.commit()
+
+    for query in (u"apple", u"neap", u"pineapple", u"juice"):
+        assert search.count(search.parse_query(query)) == 1, query
+    assert search.count(search.parse_query(u"apples")) == 0
+
+    # Trigrams of words no longer on any page are gone.
+    search.update_words(u"Fruit", u"banana juice")
+    search.db.commit()
+    assert search.count(search.parse_query(u"apple")) == 0
+    assert search.count(search.parse_query(u"nana")) == 1
+
+
+def test_similar_titles():
+    titles = TitleIndex()
+    titles.load([u"FrontPage", u"FrontPages", u"BackPage", u"Other"])
+
+    assert [title for score, title in titles.similar(u"FrontPag")] == \
+            [u"FrontPage", u"FrontPages"]
+    assert titles.similar(u"Unrelated") == []
+
+    titles.remove(u"FrontPage")
+    titles.add(u"FrontPagr")
+    assert [title for score, title in titles.similar(u"FrontPag")] == \
+            [u"FrontPagr", u"FrontPages"]
+    assert titles.complete(u"front") == [u"FrontPages", u"FrontPagr"]
+
+
+def test_link_graph():
+    links = LinkGraph()
+    links.load([u"FrontPage", u"Docs", u"Lonely"], [(u"FrontPage", u"Docs"),
+        (u"FrontPage", u"Missing"), (u"Docs", u"Missing")])
+
+    assert links.backlinks(u"Docs") == [u"FrontPage"]
+    assert links.backlinks(u"Missing") == [u"Docs", u"FrontPage"]
+    assert links.orphaned() == [u"FrontPage", u"Lonely"]
+    assert links.wanted() == [(2, u"Missing")]
+
+    links.set_links(u"Docs", [u"Lonely"])
+    assert links.orphaned() == [u"FrontPage"]
+    assert links.wanted() == [(1, u"Missing")]
+
+    links.add_title(u"Missing")
+    assert links.wanted() == []
+    assert links.backlinks(u"Missing") == [u"FrontPage"]
+
+    links.remove_title(u"Docs")
+    assert links.wanted() == [(1, u"Docs")]
+    assert links.backlinks(u"Lonely") == [u"Docs"]
+
+
+def test_backlinks_from_database(search):
+    search.update_links(u"FrontPage", [(u"Docs", u"docs")])
+    search.update_links(u"Docs", [(u"FrontPage", u"home")])
+    search.db.commit()
+
+    assert list(search.page_backlinks(u"Docs")) == [u"FrontPage"]
+    assert list(search.orphaned_pages()) == []
+    assert list(search.wanted_pages()) == []
+
+    search.update_links(u"FrontPage", [(u"Missing", u"missing")])
+    search.db.commit()
+    assert list(search.page_backlinks(u"Docs")) == []
+    assert list(search.orphaned_pages()) == [u"Docs"]
+    assert list(search.wanted_pages()) == [(1, u"Missing")]
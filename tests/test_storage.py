@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import pytest
+
+from threading import Event, Thread
+
+from sahriswiki.storage import WikiSubdirectoryIndexesStorage
+
+
+@pytest.fixture
+def storage(tmpdir):
+    config = {"indexes": ["Index", "index.html", "index.rst"],
+            "index": "Index"}
+    return WikiSubdirectoryIndexesStorage(config, str(tmpdir.join("wiki")))
+
+
+def test_page_meta_after_rollback(storage):
+    storage.save_text(u"FrontPage", u"first", u"alice", u"first")
+    storage.save_text(u"FrontPage", u"second", u"bob", u"second")
+    assert storage.page_meta(u"FrontPage")[3] == u"bob"
+
+    # The cached tip no longer exists, the metadata is read again.
+    storage.repo.rollback()
+    storage.refresh()
+
+    rev, node, date, author, comment = storage.page_meta(u"FrontPage")
+    assert (rev, author, comment) == (0, u"alice", u"first")
+
+
+def test_index_while_reopening(storage):
+    storage.save_text(u"FrontPage", u"text")
+
+    # The background Indexer drops the index whenever it reopens the repo.
+    stop = Event()
+
+    def reopen():
+        while not stop.is_set():
+            storage.reopen()
+
+    thread = Thread(target=reopen)
+    thread.start()
+    try:
+        for i in xrange(1000):
+            assert u"FrontPage" in storage
+            assert u"Missing" not in storage
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_contains(storage):
+    assert u"FrontPage" not in storage
+    assert u"" not in storage
+
+    storage.save_text(u"FrontPage", u"text")
+    storage.save_text(u"Docs/Install", u"text")
+    assert u"FrontPage" in storage
+    assert u"Docs/Install" in storage
+    assert u"Docs/Missing" not in storage
+
+    storage.delete_page(u"FrontPage")
+    assert u"FrontPage" not in storage
+    assert u"Docs/Install" in storage
+
+    # The index is built again from the dirstate.
+    storage.reopen()
+    assert u"FrontPage" not in storage
+    assert u"Docs/Install" in storage
+
+
+def test_refresh(storage):
+    storage.save_text(u"FrontPage", u"text")
+    changes = []
+    storage.subscribe(changes.append)
+
+    # Nothing changed outside
+    assert storage.refresh() is False
+
+    other = WikiSubdirectoryIndexesStorage(storage.config, storage.path)
+    other.save_text(u"Other", u"text")
+    assert u"Other" not in storage
+
+    assert storage.refresh() is True
+    assert changes == [[u"Other"]]
+    assert u"Other" in storage
+    assert storage.repo_node() == other.repo_node()
+
+    assert storage.refresh() is False
+    assert changes == [[u"Other"]]